@@ -2,13 +2,27 @@ from __future__ import print_function, division
 from glob import glob
 from collections import defaultdict
 from collections import Counter
+from collections import OrderedDict
 from collections import namedtuple
 from sklearn.model_selection import StratifiedKFold
 import json
 import csv
 import logging
+import multiprocessing
 import os
+import pickle
+import re
+import shutil
+import sys
+import tempfile
 import numpy as np
+import dataset_stats
+import imputation
+from list_files import file_digest, find_list, list_suffixes, open_list, split_list_suffix
+import mmsi_index
+import normalized_lists
+import partitioning
+import provenance
 logging.getLogger().setLevel('INFO')
 
 
@@ -53,6 +67,12 @@ assert keys[1] == 'label', '"label" must appear second in `keys`'
 
 output_keys = keys + ['split', 'source']
 
+scalar_keys = keys[2:]
+
+# Combined records store their sources as provenance masks over this table;
+# see `provenance`.
+source_table = provenance.SourceTable()
+
 # TODO: use class instead of namedtuple
 VesselRecord = namedtuple("VesselRecord", output_keys)
 
@@ -162,6 +182,9 @@ def to_float(x, key):
 
     * 'ft' are converted to meters
 
+    * 'nan' is treated as missing, as the normalized store (which keeps
+      missing values as NaN) reads it back.
+
     """
     x = x.strip()
     if not x or x in ('NA', 'n/a'):
@@ -175,72 +198,539 @@ def to_float(x, key):
     else:
         scale = 1    
     try:
-        return scale * float(x)
+        value = scale * float(x)
     except:
         logging.warn('Could not convert %s value %s to float', key, x)
         return None
+    return None if np.isnan(value) else value
     
     
-def load_lists(directory):
+#
+# Source manifest
+#
+
+# Keys in the metadata `headers` maps, which predate `keys` and spell
+# 'engine_power' with a space.
+header_keys = {key: ('engine power' if (key == 'engine_power') else key) for key in keys}
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def read_csv_columns(path):
+    """Return the column names from the first line of a csv file"""
+    with open_list(path) as f:
+        for row in csv.reader(f):
+            return list(row)
+    return []
+
+
+def check_source_info(info, columns):
+    """Validate the metadata for one source against its csv columns
+
+    Args:
+        info : dict
+            metadata loaded from the source's '.json' file
+        columns : list of str
+            column names from the first line of the source's '.csv' file
+
+    Returns:
+        (headers, errors, warnings) where `headers` maps each of `keys` to
+        a column name (or None).
+
+    Errors are problems that would make parsing the source fail, such as
+    a header mapped to a column that is not in the csv. Warnings are
+    problems that only lose information, such as a label mapped to
+    something outside of `valid_labels`; rows with those labels are
+    dropped by `LabelConverter`.
+
+    """
+    errors = []
+    warnings = []
+    raw_headers = info.get('headers')
+    if not isinstance(raw_headers, dict):
+        return {}, ['metadata has no "headers" map'], warnings
+    headers = {}
+    for key in keys:
+        hdr = raw_headers.get(header_keys[key])
+        if hdr is not None and hdr not in columns:
+            errors.append('{} column {} not in csv columns {}'.format(key, repr(hdr), columns))
+        headers[key] = hdr
+    if headers['mmsi'] is None:
+        errors.append('no mmsi column')
+    for hkey in sorted(set(raw_headers) - set(header_keys.values())):
+        warnings.append('unrecognized header key {}'.format(repr(hkey)))
+    for k, v in sorted((info.get('mappings') or {}).items()):
+        if v is None:
+            continue
+        for sub_label in v.lower().split('|'):
+            sub_label = sub_label.strip()
+            if sub_label not in valid_labels and sub_label not in null_labels:
+                warnings.append('label {} mapped to invalid label {}'.format(repr(k), repr(v)))
+                break
+    return headers, errors, warnings
+
+
+def compile_manifest(directory):
+    """Build a manifest describing every list in `directory`
+
+    Args:
+        directory : str
+            directory containing lists ('.csv') and metadata ('.json') files
+
+    Only the metadata and the first line of each list are read, so this is
+    cheap compared to `load_lists`. Each entry records the validated headers,
+    label mappings, file size and hash of one list and the hash of its
+    metadata, along with any errors or warnings found by `check_source_info`.
+
+    """
+    sources = []
+    csv_paths = [x for suffix in list_suffixes for x in glob(os.path.join(directory, '*' + suffix))]
+    seen = {}
+    for csv_pth in sorted(csv_paths):
+        base = split_list_suffix(csv_pth)[0]
+        name = os.path.basename(base)
+        json_pth = base + '.json'
+        source = {'name': name,
+                  'csv': os.path.basename(csv_pth),
+                  'json': os.path.basename(json_pth),
+                  'size': os.path.getsize(csv_pth),
+                  'sha1': file_digest(csv_pth),
+                  'json_sha1': None,
+                  'headers': {},
+                  'mappings': None,
+                  'errors': [],
+                  'warnings': []}
+        if name in seen:
+            source['errors'].append('duplicate of {}'.format(seen[name]))
+        elif not os.path.exists(json_pth):
+            source['errors'].append('missing metadata file {}'.format(source['json']))
+        else:
+            with open(json_pth) as f:
+                info = json.load(f)
+            source['json_sha1'] = file_digest(json_pth)
+            headers, errors, warnings = check_source_info(info, read_csv_columns(csv_pth))
+            source.update(headers=headers, mappings=info.get('mappings'),
+                          errors=errors, warnings=warnings)
+        seen.setdefault(name, source['csv'])
+        sources.append(source)
+    return {'sources': sources}
+
+
+def write_manifest(manifest, path):
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def read_manifest(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def check_manifest(manifest, directory):
+    """Raise ValueError if any source in `manifest` is unusable
+
+    Warnings are logged. Sources whose list or metadata no longer hash to
+    the values recorded in the manifest are treated as errors, since the
+    manifest (which holds the headers and mappings used for loading) is
+    then stale and must be recompiled. So are lists added to `directory`
+    after the manifest was compiled, which would otherwise be skipped.
+
+    """
+    problems = []
+    listed = {source['csv'] for source in manifest['sources']}
+    for suffix in list_suffixes:
+        for csv_pth in sorted(glob(os.path.join(directory, '*' + suffix))):
+            file_name = os.path.basename(csv_pth)
+            if file_name not in listed:
+                problems.append('{}: not in manifest'.format(file_name))
+    for source in manifest['sources']:
+        for warning in source['warnings']:
+            logging.warning('%s: %s', source['name'], warning)
+        errors = list(source['errors'])
+        csv_pth = os.path.join(directory, source['csv'])
+        json_pth = os.path.join(directory, source['json'])
+        if not os.path.exists(csv_pth):
+            errors.append('missing list file {}'.format(source['csv']))
+        elif (os.path.getsize(csv_pth) != source['size'] or
+                file_digest(csv_pth) != source['sha1']):
+            errors.append('{} changed since manifest was compiled'.format(source['csv']))
+        if not source['errors']:
+            if not os.path.exists(json_pth):
+                errors.append('missing metadata file {}'.format(source['json']))
+            elif file_digest(json_pth) != source.get('json_sha1'):
+                errors.append('{} changed since manifest was compiled'.format(source['json']))
+        problems.extend('{}: {}'.format(source['name'], x) for x in errors)
+    if problems:
+        raise ValueError('Invalid sources (recompile the manifest with --compile-manifest '
+                         'if lists were added or changed):\n  ' + '\n  '.join(problems))
+
+
+#
+# Filtering rows by mmsi before they are converted
+#
+
+# Loose check for MMSI that are plainly malformed; only applied on request
+# since some lists use short identifiers (e.g. for gear).
+mmsi_pattern = re.compile(r'^[0-9]{1,9}$')
+
+
+def read_mmsi_list(path):
+    """Return the set of (stripped) values in the 'mmsi' column of `path`"""
+    with open_list(path) as f:
+        return {line['mmsi'].strip() for line in csv.DictReader(f)}
+
+
+class MMSIFilter(object):
+    """Decide which rows to drop, based only on their mmsi
+
+    Args:
+        excluded : set of str
+            mmsi to reject outright
+        allowed : set of str, optional
+            if supplied, reject any mmsi not in this set
+        check_format : bool
+            reject mmsi that do not match `mmsi_pattern`
+
+    Rows with a blank mmsi are always rejected. Calling the filter returns
+    None for rows that should be kept and the reason for rejection
+    otherwise, so it can be applied before the rest of a row is converted.
+
+    """
+
+    def __init__(self, excluded=(), allowed=None, check_format=False):
+        self.excluded = set(excluded)
+        self.allowed = None if (allowed is None) else set(allowed)
+        self.check_format = check_format
+
+    def __call__(self, mmsi):
+        if not mmsi.strip():
+            return 'blank'
+        if mmsi in self.excluded:
+            return 'incorrect'
+        if self.check_format and not mmsi_pattern.match(mmsi):
+            return 'invalid'
+        if self.allowed is not None and mmsi not in self.allowed:
+            return 'not_allowed'
+        return None
+
+
+def compile_mmsi_filter(base_path, allow_list_paths=(), check_format=False):
+    """Build an `MMSIFilter` from the lists in `base_path`
+
+    MMSI in 'incorrect_mmsi.csv' are excluded; if `allow_list_paths` are
+    given, only mmsi appearing in at least one of them are kept.
+
+    """
+    excluded = read_mmsi_list(find_list(base_path, 'incorrect_mmsi.csv'))
+    allowed = None
+    if allow_list_paths:
+        allowed = set()
+        for pth in allow_list_paths:
+            allowed |= read_mmsi_list(pth)
+    return MMSIFilter(excluded, allowed, check_format)
+
+
+#
+# Loading lists
+#
+
+def load_source(directory, source, mmsi_filter=None, keep_raw=False, partition=None):
+    """Load one list described by a manifest entry
+
+    Rows rejected by `mmsi_filter` (by default only those with a blank
+    mmsi) are dropped before any other column is converted. If `partition`
+    is supplied as (index, count), rows whose mmsi belongs to another
+    partition (see `partitioning.partition_of`) are skipped before that.
+
+    Returns:
+        (rows, rejected, raw, row_numbers, excluded) where each row holds a
+        value for each of `keys`, `rejected` counts dropped rows by reason
+        and `row_numbers` holds the csv row number of each row. If
+        `keep_raw` is set, `raw` lists (row number, raw values by key,
+        rejection reason, converted values by key) for every row in the
+        list, with the reason None for kept rows and the converted values
+        None for rejected ones; otherwise it is None. `excluded` lists
+        (row number, mmsi) for rows rejected as 'incorrect', which earlier
+        releases loaded and then removed; see `load_lists(first_rows=...)`.
+
+    """
+    if mmsi_filter is None:
+        mmsi_filter = MMSIFilter()
+    # Create converters
+    converters = {}
+    converters['label'] = LabelConverter(source['mappings'])
+    for lbl in keys[1:]:
+        if lbl != 'label':
+            converters[lbl] = to_float
+    #
+    headers = source['headers']
+    mmsi_key = headers['mmsi']
+    csv_pth = os.path.join(directory, source['csv'])
+    logging.info('Processing: %s', source['name'])
+    rows = []
+    row_numbers = []
+    excluded = []
+    rejected = Counter()
+    raw = [] if keep_raw else None
+    try:
+        with open_list(csv_pth) as f:
+            for row_number, line in enumerate(csv.DictReader(f)):
+                if (partition is not None and
+                        partitioning.partition_of(line[mmsi_key], partition[1]) != partition[0]):
+                    continue
+                reason = mmsi_filter(line[mmsi_key])
+                if keep_raw:
+                    raw_values = {key: line[hdr] for (key, hdr) in headers.items()
+                                    if hdr is not None}
+                if reason is not None:
+                    rejected[reason] += 1
+                    if reason == 'incorrect':
+                        excluded.append((row_number, line[mmsi_key]))
+                    if keep_raw:
+                        raw.append((row_number, raw_values, reason, None))
+                    continue
+                chunks = []
+                for key in keys:
+                    hdr = headers.get(key)
+                    if hdr is None:
+                        value = None
+                    else:
+                        value = line[hdr]
+                        if key in converters:
+                            value = converters[key](value, key)
+                    chunks.append(value)
+                rows.append(chunks)
+                row_numbers.append(row_number)
+                if keep_raw:
+                    raw.append((row_number, raw_values, None, dict(zip(keys, chunks))))
+    except:
+        logging.warning("Failed loading from: %s", csv_pth)
+        raise
+    if rejected:
+        logging.info('Rejected rows from %s: %s', source['name'], dict(rejected))
+    return rows, rejected, raw, row_numbers, excluded
+
+
+def _load_source_star(args):
+    return load_source(*args)
+
+
+#
+# Normalized store shared with vessel_labelling; see `normalized_lists`
+#
+
+def _keep_all(mmsi):
+    return None
+
+
+def ingest_source(directory, source):
+    """Parse one list into the columns of a normalized store
+
+    Every row is kept, including those an `MMSIFilter` would reject, since
+    filtering happens when the store is read.
+
+    """
+    raw = load_source(directory, source, mmsi_filter=_keep_all, keep_raw=True)[2]
+    label_key = source['headers']['label']
+    columns = {'mmsi': [values['mmsi'] for (_, values, _, _) in raw],
+               'raw_label': [values['label'] if label_key else '' for (_, values, _, _) in raw],
+               'label': [converted['label'] or '' for (_, _, _, converted) in raw],
+               'row': [row for (row, _, _, _) in raw]}
+    for key in scalar_keys:
+        columns[key] = [converted[key] for (_, _, _, converted) in raw]
+    return columns
+
+
+def _ingest_source_star(args):
+    return ingest_source(*args)
+
+
+def update_normalized(store, directory, manifest, processes=None):
+    """Bring the normalized store in `store` up to date with `manifest`
+
+    Only lists that changed (or are new) since they were last ingested
+    are parsed; entries for lists no longer in the manifest are dropped.
+    Each list is hashed here rather than trusting the hash recorded in
+    `manifest`, so stale columns are never served.
+
+    Returns:
+        the store index.
+
+    """
+    if not os.path.exists(store):
+        os.makedirs(store)
+    index = normalized_lists.read_index(store)
+    sources = [dict(x, sha1=file_digest(os.path.join(directory, x['csv'])))
+                   for x in manifest['sources']]
+    stale = [x for x in sources if not normalized_lists.is_current(
+                index['sources'].get(x['name']), x)]
+    tasks = [(directory, x) for x in stale]
+    if processes and tasks:
+        pool = multiprocessing.Pool(processes)
+        try:
+            ingested = pool.map(_ingest_source_star, tasks, chunksize=1)
+        finally:
+            pool.close()
+    else:
+        ingested = [_ingest_source_star(x) for x in tasks]
+    entries = {x['name']: index['sources'].get(x['name']) for x in sources}
+    for source, columns in zip(stale, ingested):
+        logging.info('Ingested %s into %s', source['name'], store)
+        entries[source['name']] = normalized_lists.write_source(store, source, columns)
+    if entries != index['sources']:
+        index['sources'] = entries
+        normalized_lists.write_index(store, index)
+    return index
+
+
+def read_normalized(store, directory, manifest):
+    """Return the index of the normalized store in `store` without updating it
+
+    Raises ValueError unless every list in `manifest` is current in the
+    store, so that readers running alongside each other (such as partition
+    workers) never write to it; bring it up to date with
+    `update_normalized` (--update-normalized) first.
+
+    """
+    index = normalized_lists.read_index(store)
+    stale = [x['name'] for x in manifest['sources']
+                 if not normalized_lists.is_current(
+                     index['sources'].get(x['name']),
+                     dict(x, sha1=file_digest(os.path.join(directory, x['csv']))))]
+    if stale:
+        raise ValueError('Normalized store {} is not current for {} (run with '
+                         '--update-normalized first)'.format(store, ', '.join(stale)))
+    return index
+
+
+def load_normalized(store, entry, source, mmsi_filter=None, partition=None):
+    """Load one list from a normalized store
+
+    Returns the same (rows, rejected, None, row_numbers, excluded) as
+    `load_source` would for the csv the entry was built from.
+
+    """
+    if mmsi_filter is None:
+        mmsi_filter = MMSIFilter()
+    columns = normalized_lists.read_source(store, entry)
+    has_label = source['headers'].get('label') is not None
+    labels = normalized_lists.decode_text(columns['label'])
+    scalars = [[None if np.isnan(x) else x for x in columns[key].tolist()]
+                   for key in scalar_keys]
+    csv_rows = columns['row'].tolist()
+    rows = []
+    row_numbers = []
+    excluded = []
+    rejected = Counter()
+    for i, mmsi in enumerate(normalized_lists.decode_text(columns['mmsi'])):
+        if (partition is not None and
+                partitioning.partition_of(mmsi, partition[1]) != partition[0]):
+            continue
+        reason = mmsi_filter(mmsi)
+        if reason is not None:
+            rejected[reason] += 1
+            if reason == 'incorrect':
+                excluded.append((csv_rows[i], mmsi))
+            continue
+        rows.append([mmsi, labels[i] if has_label else None] + [x[i] for x in scalars])
+        row_numbers.append(csv_rows[i])
+    if rejected:
+        logging.info('Rejected rows from %s: %s', source['name'], dict(rejected))
+    return rows, rejected, None, row_numbers, excluded
+
+
+def load_lists(directory, manifest=None, processes=None, mmsi_filter=None, rejected=None,
+               raw=None, partition=None, store=None, first_rows=None, update_store=True):
     """Load and normalize lists
 
     Args:
         directory : str
             directory containing lists ('.csv') and metadata ('.json') files
+        manifest : dict, optional
+            manifest from `compile_manifest` or `read_manifest`; compiled
+            from `directory` if not supplied.
+        processes : int, optional
+            if supplied, load lists in parallel using this many processes.
+        mmsi_filter : MMSIFilter, optional
+            applied to each row before conversion; see `load_source`.
+        rejected : dict, optional
+            if supplied, updated with a Counter of rejected rows by reason
+            for each source.
+        raw : dict, optional
+            if supplied, updated with the raw rows of each source, in
+            manifest order; see `load_source`.
+        partition : (int, int), optional
+            if supplied as (index, count), only load rows of that partition;
+            see `load_source`.
+        store : str, optional
+            directory of a normalized store (see `normalized_lists`); lists
+            are ingested into it if they changed and then read from it
+            instead of from the csv files. Ignored if `raw` is supplied.
+        update_store : bool, optional
+            if False, `store` is only read and must already be current;
+            see `read_normalized`.
+        first_rows : dict, optional
+            if supplied, updated with the position (index of the source in
+            the manifest, csv row number) of the first row loaded for each
+            mmsi, including mmsi whose rows were all rejected as
+            'incorrect'. Earlier releases loaded those and removed them
+            afterwards, so they are needed to reproduce the order in which
+            those releases iterated the combined records (see
+            `partitioning.legacy_order`).
 
     Lists are loaded from the directory and labels are normalized using 
-    the matching metadata file. Scalar values are  converted to float 
+    the label mappings in the manifest. Scalar values are converted to float 
     using the `to_float` function defined above.
 
+    The whole manifest is checked before any list is parsed. Lists are
+    loaded largest first, then merged in manifest order so that the result
+    does not depend on scheduling.
+
     """
-    mapping = defaultdict(lambda : [[] for x in output_keys])
-    csv_paths = sorted(glob(os.path.join(directory, '*.csv')))
-    for csv_pth in csv_paths:
-        name = os.path.splitext(os.path.basename(csv_pth))[0]
-        logging.info('Processing: %s', name)
-        json_pth = os.path.splitext(csv_pth)[0] + '.json'
-        with open(json_pth) as f:
-            info = json.load(f)
-        # Create converters
-        map = info.get('mappings', {})
-        converters = {}
-        converters['label'] = LabelConverter(map)
-        for lbl in keys[1:]:
-            if lbl != 'label':
-                converters[lbl] = to_float
-        #
-        headers = info['headers']
-        mmsi_key = info['headers']['mmsi']
+    if manifest is None:
+        manifest = compile_manifest(directory)
+    check_manifest(manifest, directory)
+    sources = manifest['sources']
+    schedule = sorted(sources, key=lambda x: -x['size'])
+    if store is not None and raw is None:
+        if update_store:
+            index = update_normalized(store, directory, manifest, processes)
+        else:
+            index = read_normalized(store, directory, manifest)
+        loaded = [load_normalized(store, index['sources'][x['name']], x, mmsi_filter, partition)
+                      for x in schedule]
+    elif processes:
+        tasks = [(directory, x, mmsi_filter, raw is not None, partition) for x in schedule]
+        pool = multiprocessing.Pool(processes)
         try:
-            with open(csv_pth, 'rU') as f:
-                for line in csv.DictReader(f):
-                    chunks = []
-                    for i, key in enumerate(keys):
-                        # TODO: make this less hacky
-                        hkey = 'engine power' if (key == 'engine_power') else key
-                        hdr = headers.get(hkey)
-                        if hdr is None:
-                            value = None
-                        else:
-                            try:
-                                value = line[hdr]
-                            except KeyError:
-                                logging.fatal('could not find key ({}) in {}'.format(hdr, line.keys()))
-                                raise
-                            if key in converters:
-                                value = converters[key](value, key)
-                        chunks.append(value)
-                    if not chunks[0].strip():
-                        # empty mmsi
-                        print("Skipping", line)
-                        continue
-                    for i in range(len(keys)):
-                        mapping[chunks[0]][i].append(chunks[i])
-                    mapping[chunks[0]][-2].append(None)
-                    mapping[chunks[0]][-1].append(name)
-        except:
-            logging.warning("Failed loading from: %s", csv_pth)
-            raise
+            loaded = pool.map(_load_source_star, tasks, chunksize=1)
+        finally:
+            pool.close()
+    else:
+        loaded = [load_source(directory, x, mmsi_filter, raw is not None, partition)
+                      for x in schedule]
+    loaded_by_name = {x['name']: result for (x, result) in zip(schedule, loaded)}
+    if rejected is not None:
+        rejected.update({name: x[1] for (name, x) in loaded_by_name.items()})
+    if raw is not None:
+        for source in sources:
+            raw[source['name']] = loaded_by_name[source['name']][2]
+    #
+    mapping = defaultdict(lambda : [[] for x in output_keys])
+    for position, source in enumerate(sources):
+        name = source['name']
+        rows, _, _, row_numbers, excluded = loaded_by_name[name]
+        if first_rows is not None:
+            for row_number, mmsi in excluded:
+                if mmsi not in first_rows:
+                    first_rows[mmsi] = (position, row_number)
+        for chunks, row_number in zip(rows, row_numbers):
+            if first_rows is not None and chunks[0] not in first_rows:
+                first_rows[chunks[0]] = (position, row_number)
+            for i in range(len(keys)):
+                mapping[chunks[0]][i].append(chunks[i])
+            mapping[chunks[0]][-2].append(None)
+            mapping[chunks[0]][-1].append(name)
     for k in mapping:
         mapping[k] = VesselRecord(*(mapping[k]))
     return mapping
@@ -286,7 +776,12 @@ def combine_classes(classes):
     
     
 
-def combine_scalars(values, alpha=0.1):
+# Scalars whose standard deviation exceeds this fraction of their mean are
+# considered to disagree; see `combine_scalars`.
+SCALAR_ALPHA = 0.1
+
+
+def combine_scalars(values, alpha=SCALAR_ALPHA):
     """
     Combine scalar values by taking the mean of all set values.
     
@@ -308,8 +803,10 @@ def combine_scalars(values, alpha=0.1):
     return mean
 
 
-def combine_names(names):
-    return(';'.join(sorted(set(names))))
+def combine_names(names, table=None):
+    """Return the provenance mask for `names` in `table`"""
+    table = source_table if (table is None) else table
+    return table.mask(names)
 
 
 def combine_mmsi(values):
@@ -320,7 +817,19 @@ def combine_mmsi(values):
     return mmsi
 
 
-def combine_fields(mapping):
+def combine_fields(mapping, table=None, decisions=None):
+    """Combine the values loaded for each vessel into one `VesselRecord`
+
+    Sources are recorded as provenance masks over `table` (by default the
+    module level `source_table`), which renders them alphabetically followed
+    by any later additions such as those from `add_class`.
+
+    If `decisions` is supplied, it is updated with the inputs and result
+    of combining the label ('label') and each scalar ('scalars') of every
+    mmsi, as {'inputs': [...], 'result': ...}.
+
+    """
+    table = source_table if (table is None) else table
     new_mapping = {}
     for mmsi, values in mapping.items():
         new_values = []
@@ -332,65 +841,101 @@ def combine_fields(mapping):
             elif key == 'split':
                 new_values.append(None)
             elif key == 'source':
-                new_values.append(combine_names(keyvalues))
+                new_values.append(combine_names(keyvalues, table))
             else:
                 new_values.append(combine_scalars(keyvalues))
         new_mapping[mmsi] = VesselRecord(*new_values)
+        if decisions is not None:
+            record = new_mapping[mmsi]
+            decisions[mmsi] = {
+                'label': {'inputs': list(values.label), 'result': record.label},
+                'scalars': {key: {'inputs': list(getattr(values, key)),
+                                  'result': getattr(record, key)} for key in scalar_keys}}
     return new_mapping
             
 
-def apply_corrections(combined, base_path):
-    # Remove incorrect MMSI
-    with open(os.path.join(base_path, 'incorrect_mmsi.csv')) as f:
+def apply_corrections(combined, base_path, changes=None, corrected=None):
+    """Apply the corrections in `base_path` to `combined` in place
+
+    If `changes` is supplied, (mmsi, kind, description) is appended to it
+    for each correction made. If `corrected` is supplied, it is updated
+    with the set of keys corrected for each mmsi, so that imputation leaves
+    them alone (a correction may deliberately blank a value).
+
+    """
+    changes = [] if (changes is None) else changes
+    corrected = {} if (corrected is None) else corrected
+    # Remove incorrect MMSI. This is a no-op if the lists were loaded with
+    # the filter from `compile_mmsi_filter`, which drops them up front.
+    with open_list(find_list(base_path, 'incorrect_mmsi.csv')) as f:
         removed = []
         for line in csv.DictReader(f):
             mmsi = line['mmsi'].strip()
             if mmsi in combined:
                 removed.append(mmsi)
                 combined.pop(mmsi)
+                changes.append((mmsi, 'removed', 'listed in incorrect_mmsi.csv'))
         logging.info('Removing incorrect MMSI: %s', ", ".join(removed))
 
 
     # Fix lengths
-    with open(os.path.join(base_path, 'corrected_lengths.csv')) as f:
+    with open_list(find_list(base_path, 'corrected_lengths.csv')) as f:
         for line in csv.DictReader(f):
             mmsi = line['mmsi'].strip()
             if mmsi in combined:
                 length = float(line['length'])
                 logging.info('Correcting length for MMSI: %s  (%s -> %s)', mmsi, combined[mmsi].length, length)
+                changes.append((mmsi, 'corrected', 'length: {} -> {} (corrected_lengths.csv)'.format(
+                    combined[mmsi].length, length)))
                 l = list(combined[mmsi])
                 l[keys.index('length')] = length
+                corrected.setdefault(mmsi, set()).add('length')
                 combined[mmsi] = VesselRecord(*l)
                 assert combined[mmsi].length == length
 
     # Fix tonnages
-    with open(os.path.join(base_path, 'corrected_tonnages.csv')) as f:
+    with open_list(find_list(base_path, 'corrected_tonnages.csv')) as f:
         for line in csv.DictReader(f):
             mmsi = line['mmsi'].strip()
             if mmsi in combined:
                 tonnage = float(line['tonnage'])
                 logging.info('Correcting tonnage for MMSI: %s  (%s -> %s)', mmsi, combined[mmsi].tonnage, tonnage)
+                changes.append((mmsi, 'corrected', 'tonnage: {} -> {} (corrected_tonnages.csv)'.format(
+                    combined[mmsi].tonnage, tonnage)))
                 l = list(combined[mmsi])
                 l[keys.index('tonnage')] = tonnage
+                corrected.setdefault(mmsi, set()).add('tonnage')
                 combined[mmsi] = VesselRecord(*l)
                 assert combined[mmsi].tonnage == tonnage
 
 
     # Fix powers
-    with open(os.path.join(base_path, 'corrected_engine_powers.csv')) as f:
+    with open_list(find_list(base_path, 'corrected_engine_powers.csv')) as f:
         for line in csv.DictReader(f):
             mmsi = line['mmsi'].strip()
             if mmsi in combined:
                 power = float(line['engine_power']) if line['engine_power'] else None
                 logging.info('Correcting engine power for MMSI: %s  (%s -> %s)', mmsi, combined[mmsi].engine_power, power)
+                changes.append((mmsi, 'corrected', 'engine_power: {} -> {} (corrected_engine_powers.csv)'.format(
+                    combined[mmsi].engine_power, power)))
                 l = list(combined[mmsi])
                 l[keys.index('engine_power')] = power
+                corrected.setdefault(mmsi, set()).add('engine_power')
                 combined[mmsi] = VesselRecord(*l)
                 assert combined[mmsi].engine_power == power, (combined[mmsi].engine_power, power)
 
 
-def add_class(combined, base_path, file_name, cls):
-    with open(os.path.join(base_path, file_name)) as f:
+def add_class(combined, base_path, file_name, cls, table=None, changes=None):
+    """Set the label of every mmsi in `file_name` to `cls`
+
+    MMSI not already in `combined` are added with a random split. If
+    `changes` is supplied, (mmsi, kind, description) is appended to it for
+    each record changed or added.
+
+    """
+    table = source_table if (table is None) else table
+    changes = [] if (changes is None) else changes
+    with open_list(find_list(base_path, file_name)) as f:
         np.random.seed(24)
         new_mmsi = set()
         for line in csv.DictReader(f):
@@ -402,13 +947,18 @@ def add_class(combined, base_path, file_name, cls):
             if mmsi in combined:
                 logging.info('Correcting label for MMSI: %s  (%s -> %s)', mmsi, combined[mmsi].label, cls)
                 logging.info(str(combined[mmsi]))
+                changes.append((mmsi, 'relabelled', '{} -> {} ({})'.format(
+                    combined[mmsi].label, cls, file_name)))
                 l = list(combined[mmsi])
                 l[output_keys.index('label')] = cls
-                l[output_keys.index('source')] += ';{}'.format(file_name)
+                l[output_keys.index('source')] |= table.append(file_name)
                 combined[mmsi] = VesselRecord(*l)
             else:
                 split = 'Training' if (np.random.random() < 0.5) else 'Test'
-                combined[mmsi] = VesselRecord(mmsi, cls, None, None, None, None, split, file_name)
+                changes.append((mmsi, 'added', '{} with random split {} ({})'.format(
+                    cls, split, file_name)))
+                combined[mmsi] = VesselRecord(mmsi, cls, None, None, None, None, split,
+                                              table.append(file_name))
 
 
 # 
@@ -421,35 +971,83 @@ def add_class(combined, base_path, file_name, cls):
 MIN_COUNT = 20
 
 
-def assign_splits(combined, seed=4321):
+def test_eligible_labels(label_counts):
+    """Labels whose records are candidates for the Test split
+
+    Only simple labels (no '|') and 'unknown' are eligible and they must
+    have more than MIN_COUNT examples.
+
     """
+    possible_test_labels = simple_labels | {'unknown'}
+    return {lbl for (lbl, count) in label_counts.items()
+                if lbl in possible_test_labels and count > MIN_COUNT} 
 
 
+def _record_decisions(cand_mmsi, cand_labels, test_mmsi, decisions):
+    """Record the rank of each candidate within its label and the ranks that went to Test"""
+    ranks = {}
+    counts = Counter()
+    test_ranks = defaultdict(list)
+    for mmsi, label in zip(cand_mmsi, cand_labels):
+        ranks[mmsi] = counts[label]
+        if mmsi in test_mmsi:
+            test_ranks[label].append(counts[label])
+        counts[label] += 1
+    for mmsi, label in zip(cand_mmsi, cand_labels):
+        test = test_ranks[label]
+        decisions[mmsi] = {'rank': ranks[mmsi], 'candidates': counts[label],
+                           'test_ranks': [min(test), max(test) + 1] if test else [0, 0]}
 
-    """
-    # Determine eligible test labels: 
-    #   Only simple labels (no '|') that aren't in excluded are eligible
-    #   and they must have at least MIN_COUNT examples
-    #   Not in excluded
 
-    possible_test_labels = simple_labels | {'unknown'}
+def legacy_test_mmsi(all_mmsi, labels, seed, test_labels, decisions=None):
+    """Choose the Test records with the 'legacy' split scheme
+
+    Args:
+        all_mmsi : list
+            every mmsi, in the order earlier releases iterated the combined
+            records (see `partitioning.legacy_order`)
+        labels : dict
+            label of each mmsi
+        seed : int
+        test_labels : set
+            labels eligible for Test
+        decisions : dict, optional
+            if supplied, updated with the rank of each candidate within its
+            label, the number of candidates with that label and the range
+            of ranks that went to Test
+
+    The mmsi are shuffled and the candidates split with a 2-fold
+    `StratifiedKFold`; the training part of the first fold goes to Test,
+    which is every candidate of a label after the first half or so (in
+    shuffled order).
 
-    counts = Counter(x.label for x in combined.values())
-    test_labels = {x.label for x in combined.values() 
-                     if x.label in possible_test_labels and counts[x.label] > MIN_COUNT} 
+    """
     np.random.seed(seed)
-    all_mmsi = combined.keys()
+    all_mmsi = list(all_mmsi)
     np.random.shuffle(all_mmsi)
-    cand_mmsi = [x for x in all_mmsi if combined[x].label in test_labels]
-    cand_labels = [combined[x].label for x in all_mmsi if combined[x].label in test_labels]
+    cand_mmsi = []
+    cand_labels = []
+    for x in all_mmsi:
+        label = labels[x]
+        if label in test_labels:
+            cand_mmsi.append(x)
+            cand_labels.append(label)
     #
-    folder = StratifiedKFold(n_splits=2, random_state=seed)
+    # random_state has no effect without shuffle (and newer scikit-learn
+    # rejects it), so it is not passed.
+    folder = StratifiedKFold(n_splits=2)
     #
     print(len(cand_mmsi), len(cand_labels))
 
     test_indices = list(folder.split(cand_mmsi, cand_labels))[0][0]
     test_mmsi = set([cand_mmsi[x] for x in test_indices])
-    #
+    if decisions is not None:
+        _record_decisions(cand_mmsi, cand_labels, test_mmsi, decisions)
+    return test_mmsi
+
+
+def apply_splits(combined, test_mmsi):
+    """Set the split of every record with any information in place"""
     for mmsi in combined:
         if combined[mmsi].label == 'unknown' and not any(combined[mmsi][2:-2]):
             continue # Skip if no information
@@ -459,27 +1057,463 @@ def assign_splits(combined, seed=4321):
         combined[mmsi] = VesselRecord(*lst)
 
 
-def dump(combined, path):
+def assign_splits(combined, seed=4321, label_counts=None, scheme=partitioning.DEFAULT_SPLIT_SCHEME,
+                  quotas=None, decisions=None, order=None):
+    """Assign records to the Test and Training splits
+
+    Args:
+        combined : dict
+            map from mmsi to combined `VesselRecord`, updated in place
+        seed : int
+        label_counts : dict, optional
+            number of records per label; counted from `combined` if not
+            supplied.
+        scheme : str
+            one of `partitioning.SPLIT_SCHEMES`:
+            'legacy' (the default) gives the same splits as earlier
+            releases; see `legacy_test_mmsi`. 'hash-v1' orders the
+            candidates of each label by `partitioning.split_key` and puts
+            the first `quotas[label]` in Test, so the result does not
+            depend on the order of `combined`.
+        quotas : dict, optional
+            'hash-v1' only: number of Test records to take per label; by
+            default the stratified quotas for `label_counts`. Partitioned
+            runs pass each partition its share.
+        decisions : dict, optional
+            if supplied, updated with the rank of each candidate within its
+            label, the number of candidates with that label and the range
+            of ranks that went to Test
+        order : list, optional
+            'legacy' only: the mmsi of `combined` in the order earlier
+            releases iterated them, from `partitioning.legacy_order`; by
+            default the order of `combined`. Needed on Python 2 when rows
+            were rejected while loading rather than removed afterwards.
+
+    """
+    if label_counts is None:
+        label_counts = Counter(x.label for x in combined.values())
+    test_labels = test_eligible_labels(label_counts)
+    if scheme == 'legacy':
+        labels = {k: v.label for (k, v) in combined.items()}
+        order = list(combined) if (order is None) else order
+        test_mmsi = legacy_test_mmsi(order, labels, seed, test_labels, decisions)
+    elif scheme == 'hash-v1':
+        if quotas is None:
+            quotas = partitioning.stratified_quotas(label_counts, test_labels)
+        candidates = partitioning.candidate_keys(combined, seed, quotas)
+        test_mmsi = {mmsi for (label, keys) in candidates.items()
+                        for (_, mmsi) in keys[:quotas[label]]}
+        if decisions is not None:
+            for label, keys in candidates.items():
+                for rank, (_, mmsi) in enumerate(keys):
+                    decisions[mmsi] = {'rank': rank, 'candidates': len(keys),
+                                       'test_ranks': [0, min(quotas[label], len(keys))]}
+    else:
+        raise ValueError('unknown split scheme {}'.format(repr(scheme)))
+    apply_splits(combined, test_mmsi)
+
+
+#
+# Partitioned runs
+#
+
+# Partition state is kept in files so that workers can be local processes
+# or separate machines sharing a file system. The steps, in order, are:
+#
+#   combine (worker)       load, combine and correct one partition
+#                          -> partition-<i>.pickle, partition-<i>.json
+#   counts (coordinator)   global label counts, then the Test records
+#                          ('legacy') or quota boundaries ('hash-v1')
+#                          -> splits.json
+#   keys (worker)          'hash-v1' only: candidate keys at the boundaries
+#                          -> partition-<i>-keys.json
+#   quotas (coordinator)   'hash-v1' only: each partition's quotas
+#                          -> splits.json
+#   assign (worker)        assign the splits of one partition
+#                          -> partition-<i>.pickle
+#   merge (coordinator)    merge the partitions
+#
+# With 'legacy' the coordinator needs the position, mmsi and label of every
+# record to reproduce the single process shuffle; with 'hash-v1' it only
+# sees label counts, key histograms and the keys in one histogram bucket
+# per label.
+
+def _partition_path(work_dir, index, ext):
+    return os.path.join(work_dir, 'partition-{}.{}'.format(index, ext))
+
+
+def _read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_json(obj, path):
+    with open(path, 'w') as f:
+        json.dump(obj, f)
+
+
+def _write_partition(work_dir, index, combined, names):
+    with open(_partition_path(work_dir, index, 'pickle'), 'wb') as f:
+        pickle.dump(({k: tuple(v) for (k, v) in combined.items()}, names), f, protocol=2)
+
+
+def _read_partition(work_dir, index):
+    with open(_partition_path(work_dir, index, 'pickle'), 'rb') as f:
+        records, names = pickle.load(f)
+    return {k: VesselRecord(*v) for (k, v) in records.items()}, names
+
+
+def combine_partition(work_dir, index, n_partitions, directory, base_path, manifest=None,
+                      mmsi_filter=None, seed=4321, store=None,
+                      scheme=partitioning.DEFAULT_SPLIT_SCHEME):
+    """Load, combine and correct the records of one partition
+
+    Writes the combined records and the source names their provenance
+    masks refer to, plus a summary for the coordinator. If `store` is
+    supplied it is only read, so it must be brought up to date first.
+
+    """
+    table = provenance.SourceTable()
+    rejected = {}
+    first_rows = {}
+    corrected = {}
+    mapping = load_lists(directory, manifest, mmsi_filter=mmsi_filter, rejected=rejected,
+                         partition=(index, n_partitions), store=store, first_rows=first_rows,
+                         update_store=False)
+    combined = combine_fields(mapping, table)
+    apply_corrections(combined, base_path, corrected=corrected)
+    _write_partition(work_dir, index, combined, table.names)
+    summary = {'scheme': scheme,
+               'seed': seed,
+               'label_counts': Counter(x.label for x in combined.values()),
+               'rejected': rejected,
+               'corrected': {k: sorted(v) for (k, v) in corrected.items()}}
+    if scheme == 'legacy':
+        summary['records'] = [(first_rows[k], k, combined[k].label if (k in combined) else None)
+                                  for k in first_rows]
+    else:
+        summary['histograms'] = partitioning.key_histograms(
+            partitioning.candidate_keys(combined, seed, simple_labels | {'unknown'}))
+    _write_json(summary, _partition_path(work_dir, index, 'json'))
+
+
+def gather_counts(work_dir, n_partitions):
+    """Coordinate the splits from the partition summaries
+
+    With 'legacy' this chooses the Test records of every partition; with
+    'hash-v1' it finds the histogram bucket where each label's quota falls.
+
+    Returns:
+        global label counts
+
+    """
+    summaries = [_read_json(_partition_path(work_dir, i, 'json')) for i in range(n_partitions)]
+    scheme = summaries[0]['scheme']
+    seed = summaries[0]['seed']
+    if any((x['scheme'], x['seed']) != (scheme, seed) for x in summaries):
+        raise ValueError('partitions were combined with different split schemes or seeds')
+    label_counts = Counter()
+    for x in summaries:
+        label_counts.update(x['label_counts'])
+    test_labels = test_eligible_labels(label_counts)
+    splits = {'scheme': scheme, 'seed': seed, 'label_counts': label_counts}
+    if scheme == 'legacy':
+        records = [tuple(x) for summary in summaries for x in summary['records']]
+        order = partitioning.legacy_order([(position, mmsi, label is not None)
+                                               for (position, mmsi, label) in records])
+        labels = {mmsi: label for (_, mmsi, label) in records if label is not None}
+        test_mmsi = legacy_test_mmsi(order, labels, seed, test_labels)
+        splits['test'] = [[] for _ in range(n_partitions)]
+        for mmsi in sorted(test_mmsi):
+            splits['test'][partitioning.partition_of(mmsi, n_partitions)].append(mmsi)
+    else:
+        quotas = partitioning.stratified_quotas(label_counts, test_labels)
+        splits['bounds'] = partitioning.boundaries([x['histograms'] for x in summaries], quotas)
+    _write_json(splits, os.path.join(work_dir, 'splits.json'))
+    return label_counts
+
+
+def partition_keys(work_dir, index):
+    """Write the candidate keys of one partition at the quota boundaries ('hash-v1')"""
+    splits = _read_json(os.path.join(work_dir, 'splits.json'))
+    if splits['scheme'] != 'hash-v1':
+        return
+    combined, _ = _read_partition(work_dir, index)
+    keys = partitioning.candidate_keys(combined, splits['seed'], splits['bounds'])
+    _write_json(partitioning.boundary_keys(keys, splits['bounds']),
+                _partition_path(work_dir, index, 'keys.json'))
+
+
+def gather_quotas(work_dir, n_partitions):
+    """Share the Test quotas between partitions ('hash-v1')"""
+    path = os.path.join(work_dir, 'splits.json')
+    splits = _read_json(path)
+    if splits['scheme'] != 'hash-v1':
+        return
+    histograms = [_read_json(_partition_path(work_dir, i, 'json'))['histograms']
+                      for i in range(n_partitions)]
+    keys = [_read_json(_partition_path(work_dir, i, 'keys.json')) for i in range(n_partitions)]
+    splits['shares'] = partitioning.partition_quotas(histograms, keys, splits['bounds'])
+    _write_json(splits, path)
+
+
+def assign_partition(work_dir, index):
+    """Assign the splits of one partition as decided by the coordinator"""
+    splits = _read_json(os.path.join(work_dir, 'splits.json'))
+    combined, names = _read_partition(work_dir, index)
+    if splits['scheme'] == 'legacy':
+        apply_splits(combined, set(splits['test'][index]))
+    else:
+        assign_splits(combined, splits['seed'], scheme=splits['scheme'],
+                      quotas=splits['shares'][index])
+    _write_partition(work_dir, index, combined, names)
+
+
+def merge_partitions(work_dir, n_partitions, table=None, rejected=None, corrected=None):
+    """Merge the records of all partitions
+
+    Provenance masks are translated to `table` (by default the module level
+    `source_table`). `rejected` and `corrected` are updated as by
+    `load_lists` and `apply_corrections` if supplied.
+
+    Returns:
+        (combined, label_counts)
+
+    """
+    table = source_table if (table is None) else table
+    combined = {}
+    for records, names in (_read_partition(work_dir, index) for index in range(n_partitions)):
+        local = provenance.SourceTable(names)
+        for mmsi, record in records.items():
+            combined[mmsi] = record._replace(source=table.mask(local.decode(record.source)))
+    for index in range(n_partitions):
+        summary = _read_json(_partition_path(work_dir, index, 'json'))
+        if rejected is not None:
+            for name, counts in summary['rejected'].items():
+                rejected.setdefault(name, Counter()).update(counts)
+        if corrected is not None:
+            for mmsi, corrected_keys in summary['corrected'].items():
+                corrected.setdefault(mmsi, set()).update(corrected_keys)
+    label_counts = _read_json(os.path.join(work_dir, 'splits.json'))['label_counts']
+    return combined, label_counts
+
+
+def _run_partition_step(args):
+    step, kwargs = args
+    return step(**kwargs)
+
+
+def combine_partitioned(directory, base_path, n_partitions, manifest=None, processes=None,
+                        mmsi_filter=None, seed=4321, work_dir=None, table=None,
+                        rejected=None, store=None, scheme=partitioning.DEFAULT_SPLIT_SCHEME,
+                        corrected=None):
+    """Run the partitioned pipeline with local processes
+
+    Each of `n_partitions` partitions is loaded, combined, corrected and
+    split independently, coordinated by `gather_counts` and
+    `gather_quotas`. The result is the same as `combine_fields`,
+    `apply_corrections` and `assign_splits` with `scheme` on the whole data
+    set. If `store` is supplied it is brought up to date here, once, and
+    the partitions only read from it.
+
+    Returns:
+        (combined, label_counts)
+
+    """
+    if manifest is None:
+        manifest = compile_manifest(directory)
+    check_manifest(manifest, directory)
+    if store is not None:
+        update_normalized(store, directory, manifest, processes)
+    temporary = work_dir is None
+    work_dir = tempfile.mkdtemp() if temporary else work_dir
+    pool = multiprocessing.Pool(processes or n_partitions)
+
+    def run(step, **kwargs):
+        pool.map(_run_partition_step,
+                 [(step, dict(kwargs, work_dir=work_dir, index=i)) for i in range(n_partitions)],
+                 chunksize=1)
+
+    try:
+        run(combine_partition, n_partitions=n_partitions, directory=directory,
+            base_path=base_path, manifest=manifest, mmsi_filter=mmsi_filter, seed=seed,
+            store=store, scheme=scheme)
+        gather_counts(work_dir, n_partitions)
+        if scheme == 'hash-v1':
+            run(partition_keys)
+            gather_quotas(work_dir, n_partitions)
+        run(assign_partition)
+        return merge_partitions(work_dir, n_partitions, table, rejected, corrected)
+    finally:
+        pool.close()
+        if temporary:
+            shutil.rmtree(work_dir)
+
+
+def dump(combined, path, table=None, imputed=None):
+    """Write records that have a split to `path`
+
+    If `imputed` (as returned by `imputation.impute`) is supplied, an extra
+    'imputed' column lists the keys of each record that were imputed.
+
+    """
+    table = source_table if (table is None) else table
+    fieldnames = output_keys if (imputed is None) else output_keys + ['imputed']
     with open(path, 'w') as f:
-        writer = csv.DictWriter(f, output_keys)
+        writer = csv.DictWriter(f, fieldnames)
         writer.writeheader()
         for mmsi in sorted(combined):
             values = combined[mmsi]
             if values.split:
                 d = {k : v for (k, v) in zip(output_keys, values)}
+                d['source'] = table.render(values.source)
+                if imputed is not None:
+                    d['imputed'] = ';'.join(imputed.get(mmsi, []))
                 writer.writerow(d)
 
 
 
 if __name__ == '__main__':
+    import argparse
     this_directory = os.path.abspath(os.path.dirname(__file__))
-    raw_lists = load_lists(os.path.join(this_directory, "../data-precursors/classification-list-sources"))
-    combined_lists = combine_fields(raw_lists)
+    source_dir = os.path.join(this_directory, "../data-precursors/classification-list-sources")
+    parser = argparse.ArgumentParser(description='Assemble the vessel classification list.')
+    parser.add_argument('--manifest', default=os.path.join(source_dir, MANIFEST_NAME),
+        help='Path of the source manifest to read or compile.')
+    parser.add_argument('--compile-manifest', action='store_true',
+        help='Compile the source manifest, write it to --manifest and exit.')
+    parser.add_argument('--processes', type=int, default=None,
+        help='Number of processes to use when loading lists.')
+    parser.add_argument('--allow-list', action='append', default=[],
+        help='Only keep mmsi listed in the "mmsi" column of this csv (may be repeated).')
+    parser.add_argument('--check-mmsi-format', action='store_true',
+        help='Drop rows whose mmsi is not a number of at most 9 digits.')
+    parser.add_argument('--impute', action='store_true',
+        help='Impute missing scalars and add an "imputed" column to the output.')
+    parser.add_argument('--explain-index', default=None,
+        help='Write an index of raw rows and decisions per mmsi to this path for explain.py.')
+    parser.add_argument('--report', action='append', default=[],
+        help='Write dataset statistics to this path (Markdown if it ends in .md, else JSON).')
+    parser.add_argument('--normalized', default=None,
+        help='Directory of a normalized store of the lists, also readable by '
+             'vessel_labelling; lists are parsed into it only when they change.')
+    parser.add_argument('--update-normalized', action='store_true',
+        help='Bring the --normalized store up to date and exit.')
+    parser.add_argument('--partitions', type=int, default=None,
+        help='Split the lists into this many mmsi partitions that are combined and split '
+             'independently; the output is the same as without partitions.')
+    parser.add_argument('--partition-dir', default=None,
+        help='Shared directory for partition state (a temporary directory if not given).')
+    parser.add_argument('--split-scheme', default=partitioning.DEFAULT_SPLIT_SCHEME,
+        choices=partitioning.SPLIT_SCHEMES,
+        help='How records are assigned to Test: "legacy" (the default) gives the same '
+             'splits as earlier releases, "hash-v1" orders candidates by a hash of the mmsi '
+             'so partitions exchange less data.')
+    parser.add_argument('--partition-step', default=None,
+        choices=['combine', 'counts', 'keys', 'quotas', 'assign', 'merge'],
+        help='Only run one step of a partitioned run, so partitions can run on separate '
+             'machines, in this order: "combine" for each --partition-index, "counts", '
+             '"keys" for each --partition-index, "quotas", "assign" for each '
+             '--partition-index and "merge" (the rest of the pipeline). "keys" and "quotas" '
+             'do nothing with the legacy split scheme. Requires --partitions and '
+             '--partition-dir; a --normalized store is only read, so run '
+             '--update-normalized first.')
+    parser.add_argument('--partition-index', type=int, default=None,
+        help='Partition to run a "combine", "keys" or "assign" step for.')
+    args = parser.parse_args()
+    if args.update_normalized and not args.normalized:
+        parser.error('--update-normalized requires --normalized')
+    if args.partitions and args.explain_index:
+        parser.error('--explain-index is not supported with --partitions')
+    if args.partition_step and not (args.partitions and args.partition_dir):
+        parser.error('--partition-step requires --partitions and --partition-dir')
+    if args.partition_step in ('combine', 'keys', 'assign') and args.partition_index is None:
+        parser.error('--partition-step {} requires --partition-index'.format(args.partition_step))
+
+    if args.compile_manifest:
+        manifest = compile_manifest(source_dir)
+        write_manifest(manifest, args.manifest)
+        check_manifest(manifest, source_dir)
+        sys.exit()
+    manifest = read_manifest(args.manifest) if os.path.exists(args.manifest) else None
+    if args.update_normalized:
+        manifest = manifest or compile_manifest(source_dir)
+        check_manifest(manifest, source_dir)
+        update_normalized(args.normalized, source_dir, manifest, args.processes)
+        sys.exit()
     precursor_dir = os.path.join(this_directory, "../data-precursors")
-    apply_corrections(combined_lists, precursor_dir)
-    assign_splits(combined_lists)
+    mmsi_filter = compile_mmsi_filter(precursor_dir, args.allow_list, args.check_mmsi_format)
+    raw_rows = OrderedDict() if args.explain_index else None
+    changes = []
+    corrected = {}
+    decisions = {} if args.explain_index else None
+    split_decisions = {}
+    if args.partition_step == 'combine':
+        check_manifest(manifest or compile_manifest(source_dir), source_dir)
+        combine_partition(args.partition_dir, args.partition_index, args.partitions, source_dir,
+                          precursor_dir, manifest, mmsi_filter, store=args.normalized,
+                          scheme=args.split_scheme)
+        sys.exit()
+    elif args.partition_step == 'counts':
+        gather_counts(args.partition_dir, args.partitions)
+        sys.exit()
+    elif args.partition_step == 'keys':
+        partition_keys(args.partition_dir, args.partition_index)
+        sys.exit()
+    elif args.partition_step == 'quotas':
+        gather_quotas(args.partition_dir, args.partitions)
+        sys.exit()
+    elif args.partition_step == 'assign':
+        assign_partition(args.partition_dir, args.partition_index)
+        sys.exit()
+    elif args.partition_step == 'merge':
+        combined_lists, label_counts = merge_partitions(args.partition_dir, args.partitions,
+                                                        corrected=corrected)
+    elif args.partitions:
+        combined_lists, label_counts = combine_partitioned(source_dir, precursor_dir,
+            args.partitions, manifest, processes=args.processes, mmsi_filter=mmsi_filter,
+            work_dir=args.partition_dir, store=args.normalized, scheme=args.split_scheme,
+            corrected=corrected)
+    else:
+        first_rows = {}
+        raw_lists = load_lists(source_dir, manifest, processes=args.processes,
+                               mmsi_filter=mmsi_filter, raw=raw_rows, store=args.normalized,
+                               first_rows=first_rows)
+        combined_lists = combine_fields(raw_lists, decisions=decisions)
+        apply_corrections(combined_lists, precursor_dir, changes=changes, corrected=corrected)
+        label_counts = Counter(x.label for x in combined_lists.values())
+        order = partitioning.legacy_order([(position, mmsi, mmsi in combined_lists)
+                                               for (mmsi, position) in first_rows.items()])
+        assign_splits(combined_lists, label_counts=label_counts, scheme=args.split_scheme,
+                      decisions=split_decisions, order=order)
     # Adding gear and bunkers later to not mess up existing split
-    add_class(combined_lists, precursor_dir, 'gear.csv', 'gear')
-    add_class(combined_lists, precursor_dir, 'bunkers.csv', 'bunkers')
-
-    dump(combined_lists, os.path.join(this_directory, "../data/classification_list.csv"))
+    add_class(combined_lists, precursor_dir, 'gear.csv', 'gear', changes=changes)
+    add_class(combined_lists, precursor_dir, 'bunkers.csv', 'bunkers', changes=changes)
+
+    if args.report:
+        # Report observed values only, so compute before imputation
+        report_stats = dataset_stats.compute_stats(combined_lists, scalar_keys, source_table)
+        for path in args.report:
+            dataset_stats.write_report(report_stats, path)
+    # Impute after splits are assigned so that imputed values cannot change them
+    imputed = (imputation.impute(combined_lists, scalar_keys, curated=corrected)
+                   if args.impute else None)
+
+    dump(combined_lists, os.path.join(this_directory, "../data/classification_list.csv"),
+         imputed=imputed)
+    if args.explain_index:
+        records = {}
+        for mmsi, values in combined_lists.items():
+            d = dict(zip(output_keys, values))
+            d['source'] = source_table.render(values.source)
+            d['imputed'] = (imputed or {}).get(mmsi, [])
+            records[mmsi] = d
+        meta = {'label_counts': label_counts,
+                'test_labels': sorted(test_eligible_labels(label_counts)),
+                'split_scheme': args.split_scheme,
+                'scalar_keys': scalar_keys,
+                'min_count': MIN_COUNT,
+                'alpha': SCALAR_ALPHA}
+        for mmsi, d in split_decisions.items():
+            decisions[mmsi]['split'] = d
+        mmsi_index.write_index(args.explain_index, raw_rows, changes, records, meta, decisions)
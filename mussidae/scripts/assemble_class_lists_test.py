@@ -1,11 +1,19 @@
 from __future__ import print_function, division
+from collections import Counter
 from glob import glob
 import numpy as np
+import bz2
+import gzip
 import json
+import os
+import shutil
+import tempfile
 import unittest
 from StringIO import StringIO
 import assemble_class_lists
 from assemble_class_lists import VesselRecord
+import partitioning
+import provenance
 import logging
 
 logging.getLogger().setLevel('CRITICAL')
@@ -30,6 +38,7 @@ class CheckConverters(unittest.TestCase):
         self.assertEqual(assemble_class_lists.to_float('0.3', 'key1'), 0.3)
         self.assertEqual(assemble_class_lists.to_float('1 ft', 'key2'), 0.3048)
         self.assertEqual(assemble_class_lists.to_float('malformed', 'key4'), None)
+        self.assertEqual(assemble_class_lists.to_float('nan', 'key5'), None)
 
 
     """Convert strings found in lists to floating point values
@@ -78,5 +87,339 @@ class CheckCombines(unittest.TestCase):
                 engine_power=2.0, tonnage=None, split=None, source="")})
 
 
+class CheckManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.write('good', 'mmsi,shiptype,length,tonnage\n1,Bunker,10,\n2,Handliners,20 ft,\n',
+                   example_info)
+        
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, text, info=None):
+        if text is not None:
+            with open(os.path.join(self.directory, name + '.csv'), 'w') as f:
+                f.write(text)
+        if info is not None:
+            with open(os.path.join(self.directory, name + '.json'), 'w') as f:
+                json.dump(info, f)
+
+    def test_compile_manifest(self):
+        manifest = assemble_class_lists.compile_manifest(self.directory)
+        [source] = manifest['sources']
+        self.assertEqual(source['name'], 'good')
+        self.assertEqual(source['errors'], [])
+        self.assertEqual(source['headers']['label'], 'shiptype')
+        self.assertEqual(source['headers']['engine_power'], None)
+        self.assertEqual(source['size'], 
+            os.path.getsize(os.path.join(self.directory, 'good.csv')))
+
+    def test_bad_sources_rejected(self):
+        self.write('bad_header', 'mmsi,label\n3,Bunker\n', example_info)
+        self.write('no_metadata', 'mmsi\n4\n')
+        manifest = assemble_class_lists.compile_manifest(self.directory)
+        errors = {x['name'] : x['errors'] for x in manifest['sources']}
+        self.assertEqual(len(errors['bad_header']), 3)
+        self.assertEqual(len(errors['no_metadata']), 1)
+        with self.assertRaises(ValueError):
+            assemble_class_lists.load_lists(self.directory, manifest)
+
+    def test_invalid_mapping_warns(self):
+        info = json.loads(json.dumps(example_info))
+        info['mappings']['Dredger'] = 'dredger'
+        self.write('good', 'mmsi,shiptype,length,tonnage\n1,Dredger,10,\n', info)
+        manifest = assemble_class_lists.compile_manifest(self.directory)
+        [source] = manifest['sources']
+        self.assertEqual(source['errors'], [])
+        self.assertEqual(len(source['warnings']), 1)
+
+    def test_stale_manifest_rejected(self):
+        manifest = assemble_class_lists.compile_manifest(self.directory)
+        info = json.loads(json.dumps(example_info))
+        info['mappings']['Bunker'] = 'Cargo'
+        self.write('good', None, info)
+        with self.assertRaises(ValueError):
+            assemble_class_lists.load_lists(self.directory, manifest)
+        # A list edited without changing its size is also caught.
+        manifest = assemble_class_lists.compile_manifest(self.directory)
+        self.write('good', 'mmsi,shiptype,length,tonnage\n3,Bunker,10,\n2,Handliners,20 ft,\n')
+        with self.assertRaises(ValueError):
+            assemble_class_lists.load_lists(self.directory, manifest)
+        manifest = assemble_class_lists.compile_manifest(self.directory)
+        mapping = assemble_class_lists.load_lists(self.directory, manifest)
+        self.assertEqual(mapping['3'].label, ['cargo'])
+
+    def test_unlisted_source_rejected(self):
+        manifest = assemble_class_lists.compile_manifest(self.directory)
+        self.write('other', 'mmsi,shiptype,length,tonnage\n3,Research,5,\n', example_info)
+        with self.assertRaises(ValueError) as context:
+            assemble_class_lists.load_lists(self.directory, manifest)
+        self.assertIn('other.csv: not in manifest', str(context.exception))
+        self.assertIn('--compile-manifest', str(context.exception))
+        manifest = assemble_class_lists.compile_manifest(self.directory)
+        mapping = assemble_class_lists.load_lists(self.directory, manifest)
+        self.assertEqual(sorted(mapping), ['1', '2', '3'])
+
+    def test_load_lists(self):
+        manifest = assemble_class_lists.compile_manifest(self.directory)
+        mapping = assemble_class_lists.load_lists(self.directory, manifest)
+        self.assertEqual(sorted(mapping), ['1', '2'])
+        self.assertEqual(mapping['1'].label, ['tanker'])
+        self.assertEqual(mapping['2'].length, [20 * 0.3048])
+        self.assertEqual(mapping['2'].source, ['good'])
+
+    def test_mmsi_filter(self):
+        self.write('good', 'mmsi,shiptype,length,tonnage\n1,Bunker,10,\n2,Handliners,bad,\n'
+                           ' ,Bunker,,\n3x,Bunker,,\n', example_info)
+        mmsi_filter = assemble_class_lists.MMSIFilter(excluded={'2'}, check_format=True)
+        rejected = {}
+        mapping = assemble_class_lists.load_lists(self.directory, mmsi_filter=mmsi_filter,
+                                                  rejected=rejected)
+        self.assertEqual(sorted(mapping), ['1'])
+        self.assertEqual(rejected, {'good': {'blank': 1, 'incorrect': 1, 'invalid': 1}})
+        self.assertEqual(assemble_class_lists.MMSIFilter(allowed={'1'})('2'), 'not_allowed')
+
+    def test_pushdown_order(self):
+        # Earlier releases loaded incorrect mmsi and removed them after combining
+        self.write('other', 'mmsi,shiptype,length,tonnage\n' +
+                   ''.join('{},Bunker,,\n'.format(x) for x in range(100, 160)), example_info)
+        excluded = {'2'} | {str(x) for x in range(100, 160, 7)}
+        table = provenance.SourceTable()
+        combined = assemble_class_lists.combine_fields(
+            assemble_class_lists.load_lists(self.directory), table)
+        for mmsi in excluded:
+            combined.pop(mmsi)
+        first_rows = {}
+        pushed = assemble_class_lists.combine_fields(
+            assemble_class_lists.load_lists(self.directory, first_rows=first_rows,
+                mmsi_filter=assemble_class_lists.MMSIFilter(excluded=excluded)), table)
+        self.assertEqual(pushed, combined)
+        self.assertTrue(excluded < set(first_rows))
+        order = partitioning.legacy_order([(position, mmsi, mmsi in pushed)
+                                               for (mmsi, position) in first_rows.items()])
+        self.assertEqual(order, list(combined))
+        assemble_class_lists.assign_splits(combined)
+        assemble_class_lists.assign_splits(pushed, order=order)
+        self.assertEqual(pushed, combined)
+
+    def test_raw_rows(self):
+        raw = {}
+        assemble_class_lists.load_lists(self.directory, 
+            mmsi_filter=assemble_class_lists.MMSIFilter(excluded={'2'}), raw=raw)
+        [first, second] = raw['good']
+        self.assertEqual(first[:3], (0, {'mmsi': '1', 'label': 'Bunker', 'length': '10',
+                                        'tonnage': ''}, None))
+        self.assertEqual(first[3]['label'], 'tanker')
+        self.assertEqual(second[2:], ('incorrect', None))
+
+    def test_compressed_sources(self):
+        with open(os.path.join(self.directory, 'good.csv'), 'rb') as f:
+            text = f.read()
+        os.remove(os.path.join(self.directory, 'good.csv'))
+        with gzip.open(os.path.join(self.directory, 'good.csv.gz'), 'wb') as f:
+            f.write(text)
+        manifest = assemble_class_lists.compile_manifest(self.directory)
+        [source] = manifest['sources']
+        self.assertEqual((source['name'], source['csv'], source['json']),
+                         ('good', 'good.csv.gz', 'good.json'))
+        self.assertEqual(source['errors'], [])
+        mapping = assemble_class_lists.load_lists(self.directory, manifest)
+        self.assertEqual(sorted(mapping), ['1', '2'])
+        self.assertEqual(mapping['2'].length, [20 * 0.3048])
+        self.assertEqual(assemble_class_lists.find_list(self.directory, 'good.csv'),
+                         os.path.join(self.directory, 'good.csv.gz'))
+
+    def test_carriage_return_sources(self):
+        expected = assemble_class_lists.load_lists(self.directory)
+        with open(os.path.join(self.directory, 'good.csv'), 'rb') as f:
+            text = f.read().replace(b'\n', b'\r')
+        os.remove(os.path.join(self.directory, 'good.csv'))
+        for file_name, opener in [('good.csv.gz', gzip.open), ('good.csv.bz2', bz2.BZ2File)]:
+            path = os.path.join(self.directory, file_name)
+            with opener(path, 'wb') as f:
+                f.write(text)
+            manifest = assemble_class_lists.compile_manifest(self.directory)
+            self.assertEqual(manifest['sources'][0]['errors'], [])
+            mapping = assemble_class_lists.load_lists(self.directory, manifest)
+            self.assertEqual(dict(mapping), dict(expected))
+            os.remove(path)
+
+    def test_duplicate_compressed_source(self):
+        with bz2.BZ2File(os.path.join(self.directory, 'good.csv.bz2'), 'wb') as f:
+            f.write(b'mmsi,shiptype,length,tonnage\n1,Bunker,10,\n')
+        manifest = assemble_class_lists.compile_manifest(self.directory)
+        errors = {x['csv'] : x['errors'] for x in manifest['sources']}
+        self.assertEqual(errors['good.csv'], [])
+        self.assertEqual(len(errors['good.csv.bz2']), 1)
+
+
+    def test_normalized_store(self):
+        store = os.path.join(self.directory, 'store')
+        self.write('other', 'mmsi,shiptype,length,tonnage\n3,Research,5,\n', example_info)
+        expected = assemble_class_lists.load_lists(self.directory)
+        mapping = assemble_class_lists.load_lists(self.directory, store=store)
+        self.assertEqual(dict(mapping), dict(expected))
+        label_path = os.path.join(store, 'good', 'label.npy')
+        os.utime(label_path, (0, 0))
+        # Only the changed list is parsed again.
+        self.write('other', 'mmsi,shiptype,length,tonnage\n3,Research,6,\n', example_info)
+        mapping = assemble_class_lists.load_lists(self.directory, store=store)
+        self.assertEqual(os.path.getmtime(label_path), 0)
+        self.assertEqual(mapping['3'].length, [6.0])
+        # The store checks the lists themselves, not the hashes in the manifest.
+        manifest = assemble_class_lists.compile_manifest(self.directory)
+        self.write('good', 'mmsi,shiptype,length,tonnage\n3,Bunker,10,\n2,Handliners,20 ft,\n')
+        index = assemble_class_lists.update_normalized(store, self.directory, manifest)
+        rows = assemble_class_lists.load_normalized(store, index['sources']['good'],
+                                                       manifest['sources'][0])[0]
+        self.assertEqual([x[0] for x in rows], ['3', '2'])
+
+    def test_read_only_store(self):
+        store = os.path.join(self.directory, 'store')
+        manifest = assemble_class_lists.compile_manifest(self.directory)
+        with self.assertRaises(ValueError):
+            assemble_class_lists.load_lists(self.directory, manifest, store=store,
+                                            update_store=False)
+        self.assertFalse(os.path.exists(store))
+        work_dir = os.path.join(self.directory, 'work')
+        os.mkdir(work_dir)
+        with self.assertRaises(ValueError):
+            assemble_class_lists.combine_partition(work_dir, 0, 1, self.directory,
+                                                   self.directory, manifest, store=store)
+        assemble_class_lists.update_normalized(store, self.directory, manifest)
+        self.assertEqual(dict(assemble_class_lists.load_lists(self.directory, manifest,
+                                                              store=store, update_store=False)),
+                         dict(assemble_class_lists.load_lists(self.directory, manifest)))
+        # A list changed since the store was updated is not ingested.
+        self.write('good', 'mmsi,shiptype,length,tonnage\n3,Bunker,10,\n2,Handliners,20 ft,\n')
+        manifest = assemble_class_lists.compile_manifest(self.directory)
+        with self.assertRaises(ValueError) as context:
+            assemble_class_lists.load_lists(self.directory, manifest, store=store,
+                                            update_store=False)
+        self.assertIn('--update-normalized', str(context.exception))
+
+    def test_normalized_store_nan(self):
+        store = os.path.join(self.directory, 'store')
+        self.write('other', 'mmsi,shiptype,length,tonnage\n1,Bunker,nan,\n3,Research,NaN,5\n',
+                   example_info)
+        expected = assemble_class_lists.load_lists(self.directory)
+        self.assertEqual(expected['1'].length, [10.0, None])
+        for _ in range(2):
+            # Once to build the store, then again reading it back.
+            mapping = assemble_class_lists.load_lists(self.directory, store=store)
+            self.assertEqual(dict(mapping), dict(expected))
+            self.assertEqual(dict(assemble_class_lists.combine_fields(mapping)),
+                             dict(assemble_class_lists.combine_fields(expected)))
+
+
+class CheckPartitionedRun(unittest.TestCase):
+
+    labels = ['Bunker', 'Handliners', 'Research']
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.directory, 'lists')
+        self.base_path = os.path.join(self.directory, 'precursors')
+        os.mkdir(self.source_dir)
+        os.mkdir(self.base_path)
+        power_info = json.loads(json.dumps(example_info))
+        power_info['headers'].update({'engine power': 'power', 'tonnage': None})
+        rows = ['{},{},{},{}'.format(200000 + i, self.labels[i % 3], 10 + i % 7, 100 + i)
+                    for i in range(120)]
+        self.write_list('a', 'mmsi,shiptype,length,tonnage', rows, example_info)
+        rows = ['{},{},{} ft,{}'.format(200000 + 2 * i, self.labels[i % 3], 30 + i % 5, 500 + i)
+                    for i in range(80)]
+        self.write_list('b', 'mmsi,shiptype,length,power', rows[::-1], power_info)
+        rows = ['{},{},{},'.format(300000 + i, self.labels[i % 2], 20) for i in range(30)]
+        self.write_list('c', 'mmsi,shiptype,length,tonnage', rows + ['200003,Bunker,5,'],
+                        example_info)
+        self.write_precursor('incorrect_mmsi.csv', 'mmsi', ['200003', '200010', '200155',
+                                                            '300007', '999999'])
+        self.write_precursor('corrected_lengths.csv', 'mmsi,length', ['200004,55', '999999,1'])
+        self.write_precursor('corrected_tonnages.csv', 'mmsi,tonnage', ['200006,1000'])
+        self.write_precursor('corrected_engine_powers.csv', 'mmsi,engine_power',
+                             ['200008,', '200012,900'])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_list(self, name, header, rows, info):
+        with open(os.path.join(self.source_dir, name + '.csv'), 'w') as f:
+            f.write('\n'.join([header] + rows) + '\n')
+        with open(os.path.join(self.source_dir, name + '.json'), 'w') as f:
+            json.dump(info, f)
+
+    def write_precursor(self, file_name, header, rows):
+        with open(os.path.join(self.base_path, file_name), 'w') as f:
+            f.write('\n'.join([header] + rows) + '\n')
+
+    def rendered(self, combined, table):
+        return {k: (v._replace(source=None), table.render(v.source)) for (k, v) in combined.items()}
+
+    def single_process(self, scheme):
+        """The whole data set at once, as earlier releases loaded it"""
+        table = provenance.SourceTable()
+        combined = assemble_class_lists.combine_fields(
+            assemble_class_lists.load_lists(self.source_dir), table)
+        assemble_class_lists.apply_corrections(combined, self.base_path)
+        assemble_class_lists.assign_splits(combined, scheme=scheme)
+        return self.rendered(combined, table)
+
+    def run_steps(self, n_partitions, scheme, mmsi_filter):
+        """Run each step of a partitioned run in turn, as --partition-step does"""
+        work_dir = os.path.join(self.directory, 'work-{}-{}'.format(scheme, n_partitions))
+        os.mkdir(work_dir)
+        for index in range(n_partitions):
+            assemble_class_lists.combine_partition(work_dir, index, n_partitions,
+                self.source_dir, self.base_path, mmsi_filter=mmsi_filter, scheme=scheme)
+        assemble_class_lists.gather_counts(work_dir, n_partitions)
+        for index in range(n_partitions):
+            assemble_class_lists.partition_keys(work_dir, index)
+        assemble_class_lists.gather_quotas(work_dir, n_partitions)
+        for index in range(n_partitions):
+            assemble_class_lists.assign_partition(work_dir, index)
+        table = provenance.SourceTable()
+        combined, _ = assemble_class_lists.merge_partitions(work_dir, n_partitions, table)
+        return self.rendered(combined, table)
+
+    def test_partitioned_runs_match(self):
+        mmsi_filter = assemble_class_lists.compile_mmsi_filter(self.base_path)
+        for scheme in partitioning.SPLIT_SCHEMES:
+            expected = self.single_process(scheme)
+            self.assertNotIn('200003', expected)
+            self.assertEqual(expected['200004'][0].length, 55)
+            self.assertEqual(expected['200008'][0].engine_power, None)
+            self.assertEqual(expected['200012'][0].engine_power, 900)
+            splits = Counter(x.split for (x, _) in expected.values())
+            self.assertTrue(splits['Test'] > 0 and splits['Training'] > 0)
+            # With the filter pushed down, as main runs it without partitions.
+            first_rows = {}
+            table = provenance.SourceTable()
+            combined = assemble_class_lists.combine_fields(assemble_class_lists.load_lists(
+                self.source_dir, mmsi_filter=mmsi_filter, first_rows=first_rows), table)
+            corrected = {}
+            assemble_class_lists.apply_corrections(combined, self.base_path, corrected=corrected)
+            self.assertEqual(corrected, {'200004': {'length'}, '200006': {'tonnage'},
+                                         '200008': {'engine_power'},
+                                         '200012': {'engine_power'}})
+            order = partitioning.legacy_order([(position, mmsi, mmsi in combined)
+                                                  for (mmsi, position) in first_rows.items()])
+            assemble_class_lists.assign_splits(combined, scheme=scheme, order=order)
+            self.assertEqual(self.rendered(combined, table), expected)
+            for n_partitions in [1, 3]:
+                table = provenance.SourceTable()
+                merged_corrections = {}
+                combined, label_counts = assemble_class_lists.combine_partitioned(
+                    self.source_dir, self.base_path, n_partitions, processes=2,
+                    mmsi_filter=mmsi_filter, table=table, scheme=scheme,
+                    corrected=merged_corrections)
+                self.assertEqual(self.rendered(combined, table), expected, (scheme, n_partitions))
+                self.assertEqual(merged_corrections, corrected)
+                self.assertEqual(label_counts, Counter(x.label for (x, _) in expected.values()))
+                self.assertEqual(self.run_steps(n_partitions, scheme, mmsi_filter), expected,
+                                 (scheme, n_partitions))
+
+
 if __name__ == '__main__':
     unittest.main()
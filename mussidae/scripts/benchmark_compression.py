@@ -0,0 +1,113 @@
+"""Compare list parsing throughput across compression formats
+
+Copies the source lists (and their metadata) into a temporary directory
+once per format, compressing them with a streaming write, then times
+`load_lists` on each copy:
+
+    python benchmark_compression.py --repeat 3
+
+Reports on-disk size, throughput in MB of uncompressed csv per second and
+rows per second for each format. Formats whose compressor is not available
+(.csv.xz needs lzma) are skipped.
+"""
+from __future__ import print_function, division
+import argparse
+import bz2
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import time
+from assemble_class_lists import load_lists, compile_manifest
+from list_files import compressed_openers, lzma
+
+
+def _writers():
+    writers = [('.csv', lambda path: open(path, 'wb')),
+               ('.csv.gz', lambda path: gzip.open(path, 'wb')),
+               ('.csv.bz2', lambda path: bz2.BZ2File(path, 'wb'))]
+    if lzma is not None:
+        writers.append(('.csv.xz', lambda path: lzma.open(path, 'wb')))
+    return writers
+
+
+def copy_sources(source_dir, target_dir, suffix, opener, chunk_size=1 << 20):
+    """Copy the lists in `source_dir` to `target_dir`, recompressed as `suffix`
+
+    Returns:
+        (total uncompressed bytes, total bytes written)
+
+    """
+    raw_size = 0
+    for source in compile_manifest(source_dir)['sources']:
+        if source['errors']:
+            continue
+        shutil.copy(os.path.join(source_dir, source['json']), target_dir)
+        target = os.path.join(target_dir, source['name'] + suffix)
+        path = os.path.join(source_dir, source['csv'])
+        read_opener = compressed_openers.get(os.path.splitext(path)[1], open)
+        with read_opener(path, 'rb') as src:
+            with opener(target) as dst:
+                while True:
+                    chunk = src.read(chunk_size)
+                    if not chunk:
+                        break
+                    raw_size += len(chunk)
+                    dst.write(chunk)
+    written = sum(os.path.getsize(os.path.join(target_dir, x)) for x in os.listdir(target_dir)
+                      if x.endswith(suffix))
+    return raw_size, written
+
+
+def time_load(directory, repeat):
+    """Best of `repeat` timings of `load_lists` on `directory`
+
+    Returns:
+        (seconds, number of rows read, kept or rejected)
+
+    """
+    manifest = compile_manifest(directory)
+    best = None
+    for _ in range(repeat):
+        rejected = {}
+        start = time.time()
+        mapping = load_lists(directory, manifest, rejected=rejected)
+        elapsed = time.time() - start
+        best = elapsed if (best is None) else min(best, elapsed)
+    rows = sum(len(x.mmsi) for x in mapping.values())
+    return best, rows + sum(sum(x.values()) for x in rejected.values())
+
+
+def benchmark(source_dir, repeat=1):
+    """Return a list of result dicts, one per available format"""
+    results = []
+    for suffix, opener in _writers():
+        directory = tempfile.mkdtemp()
+        try:
+            raw_size, size = copy_sources(source_dir, directory, suffix, opener)
+            seconds, rows = time_load(directory, repeat)
+        finally:
+            shutil.rmtree(directory)
+        results.append({'format': suffix, 'size': size, 'ratio': raw_size / max(size, 1),
+                        'seconds': seconds, 'mb_per_s': raw_size / 1e6 / seconds,
+                        'rows_per_s': rows / seconds})
+    return results
+
+
+if __name__ == '__main__':
+    this_directory = os.path.abspath(os.path.dirname(__file__))
+    parser = argparse.ArgumentParser(description='Benchmark list parsing across compression formats.')
+    parser.add_argument('--sources', default=os.path.join(this_directory,
+                        "../data-precursors/classification-list-sources"),
+        help='Directory of source lists to benchmark with.')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='Number of timed loads per format; the best is reported.')
+    args = parser.parse_args()
+    logging.getLogger().setLevel('ERROR')
+
+    print('{:<10} {:>12} {:>7} {:>9} {:>9} {:>11}'.format(
+        'format', 'bytes', 'ratio', 'seconds', 'MB/s', 'rows/s'))
+    for r in benchmark(args.sources, args.repeat):
+        print('{format:<10} {size:>12} {ratio:>7.2f} {seconds:>9.3f} {mb_per_s:>9.2f} '
+              '{rows_per_s:>11.0f}'.format(**r))
@@ -0,0 +1,217 @@
+"""Summary statistics and class-balance reports for combined vessel lists
+
+All statistics are computed from one columnar view of the combined records,
+built by a single pass over them, using grouped numpy reductions.
+"""
+from __future__ import print_function, division
+from collections import namedtuple
+import json
+import numpy as np
+
+
+UNASSIGNED = 'Unassigned'
+
+QUANTILES = [('min', 0.0), ('p25', 0.25), ('median', 0.5), ('p75', 0.75), ('max', 1.0)]
+
+
+RecordColumns = namedtuple('RecordColumns', ['mmsi', 'labels', 'splits', 'sources', 'scalars'])
+
+
+def record_columns(combined, scalar_keys, source_table):
+    """Convert combined records to columns
+
+    Args:
+        combined : dict
+            map from mmsi to combined `VesselRecord`
+        scalar_keys : list of str
+            names of the scalar fields to extract
+        source_table : provenance.SourceTable
+            table used to decode each record's provenance mask
+
+    Returns:
+        `RecordColumns` whose `scalars` is an (n, len(scalar_keys)) float
+        array with NaN for missing values and whose `sources` holds the list
+        of source names for each record.
+
+    """
+    mmsi = sorted(combined)
+    n = len(mmsi)
+    labels = np.empty(n, dtype=object)
+    splits = np.empty(n, dtype=object)
+    sources = []
+    scalars = np.empty([n, len(scalar_keys)], dtype=float)
+    for i, x in enumerate(mmsi):
+        record = combined[x]
+        labels[i] = record.label
+        splits[i] = record.split or UNASSIGNED
+        sources.append(source_table.decode(record.source))
+        scalars[i] = [np.nan if (v is None) else v for v in
+                        (getattr(record, k) for k in scalar_keys)]
+    return RecordColumns(mmsi, labels, splits, sources, scalars)
+
+
+def _as_dict(names, values):
+    return {k: int(v) for (k, v) in zip(names, values)}
+
+
+def _scalar_stats(values, label_ix, n_labels):
+    """Fill rate and distribution of one scalar column grouped by label"""
+    present = ~np.isnan(values)
+    totals = np.bincount(label_ix, minlength=n_labels)
+    counts = np.bincount(label_ix[present], minlength=n_labels)
+    v = values[present]
+    ix = label_ix[present]
+    sums = np.bincount(ix, weights=v, minlength=n_labels)
+    means = sums / np.maximum(counts, 1)
+    sq_dev = np.bincount(ix, weights=(v - means[ix]) ** 2, minlength=n_labels)
+    stds = np.sqrt(sq_dev / np.maximum(counts, 1))
+    # Sort by label, then value, so each label's values are contiguous and
+    # ordered; quantiles are then linear interpolation within each group.
+    order = np.lexsort((v, ix))
+    v = v[order]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    quantiles = {}
+    for name, q in QUANTILES:
+        pos = starts + q * np.maximum(counts - 1, 0)
+        lo = np.floor(pos).astype(int)
+        hi = np.ceil(pos).astype(int)
+        if len(v):
+            lo_v = v[np.minimum(lo, len(v) - 1)]
+            hi_v = v[np.minimum(hi, len(v) - 1)]
+            quantiles[name] = lo_v + (pos - lo) * (hi_v - lo_v)
+        else:
+            quantiles[name] = np.zeros(n_labels)
+    by_label = []
+    for i in range(n_labels):
+        d = {'count': int(counts[i]),
+             'fill_rate': float(counts[i] / totals[i]) if totals[i] else 0.0}
+        if counts[i]:
+            d['mean'] = float(means[i])
+            d['std'] = float(stds[i])
+            for name, _ in QUANTILES:
+                d[name] = float(quantiles[name][i])
+        by_label.append(d)
+    fill_rate = float(present.sum() / len(values)) if len(values) else 0.0
+    return fill_rate, by_label
+
+
+def compute_stats(combined, scalar_keys, source_table):
+    """Compute dataset statistics for combined vessel records
+
+    Args:
+        combined : dict
+            map from mmsi to combined `VesselRecord`
+        scalar_keys : list of str
+            names of the scalar fields to summarize
+        source_table : provenance.SourceTable
+            table used to decode each record's provenance mask
+
+    Returns:
+        dict holding the total record count, counts per label, per split
+        and per label x split, the number of records each source
+        contributes to (overall, per label and as the only source), and
+        the fill rate and distribution of each scalar per label. Records
+        without a split are counted under `UNASSIGNED`.
+
+    """
+    columns = record_columns(combined, scalar_keys, source_table)
+    n = len(columns.mmsi)
+    label_names, label_ix = np.unique(columns.labels.astype(str), return_inverse=True)
+    split_names, split_ix = np.unique(columns.splits.astype(str), return_inverse=True)
+    label_ix = label_ix.reshape(-1)
+    split_ix = split_ix.reshape(-1)
+    n_labels = len(label_names)
+    n_splits = len(split_names)
+    label_names = [str(x) for x in label_names]
+    split_names = [str(x) for x in split_names]
+
+    label_counts = np.bincount(label_ix, minlength=n_labels)
+    split_counts = np.bincount(split_ix, minlength=n_splits)
+    label_split = np.bincount(label_ix * n_splits + split_ix,
+                              minlength=n_labels * n_splits).reshape(n_labels, n_splits)
+
+    # Flatten (record, source) pairs so per source counts are bincounts too.
+    n_sources = np.array([len(x) for x in columns.sources], dtype=int)
+    flat_sources = [s for x in columns.sources for s in x]
+    flat_records = np.repeat(np.arange(n), n_sources)
+    source_names, source_ix = np.unique(np.array(flat_sources, dtype=str), return_inverse=True)
+    source_ix = source_ix.reshape(-1)
+    source_names = [str(x) for x in source_names]
+    m = len(source_names)
+    source_counts = np.bincount(source_ix, minlength=m)
+    exclusive = np.bincount(source_ix[n_sources[flat_records] == 1], minlength=m)
+    source_label = np.bincount(source_ix * n_labels + label_ix[flat_records],
+                               minlength=m * n_labels).reshape(m, n_labels)
+
+    sources = {}
+    for i, name in enumerate(source_names):
+        sources[name] = {'records': int(source_counts[i]),
+                         'exclusive': int(exclusive[i]),
+                         'labels': {label_names[j]: int(c)
+                                        for (j, c) in enumerate(source_label[i]) if c}}
+
+    scalars = {}
+    for k, key in enumerate(scalar_keys):
+        fill_rate, by_label = _scalar_stats(columns.scalars[:, k], label_ix, n_labels)
+        scalars[key] = {'fill_rate': fill_rate,
+                        'by_label': dict(zip(label_names, by_label))}
+
+    return {
+        'total': n,
+        'labels': label_names,
+        'splits': split_names,
+        'label_counts': _as_dict(label_names, label_counts),
+        'split_counts': _as_dict(split_names, split_counts),
+        'label_split_counts': {lbl: _as_dict(split_names, label_split[i])
+                                    for (i, lbl) in enumerate(label_names)},
+        'sources': sources,
+        'scalars': scalars,
+    }
+
+
+def _table(header, rows):
+    # Joint labels contain '|', which must be escaped inside table cells.
+    rows = [[str(x).replace('|', '\\|') for x in row] for row in rows]
+    lines = ['| ' + ' | '.join(header) + ' |',
+             '|' + '|'.join(['---'] * len(header)) + '|']
+    for row in rows:
+        lines.append('| ' + ' | '.join(row) + ' |')
+    return lines
+
+
+def _fmt(x):
+    return '' if (x is None) else '{:.4g}'.format(x)
+
+
+def stats_to_markdown(stats):
+    """Render the output of `compute_stats` as a Markdown report"""
+    splits = stats['splits']
+    lines = ['# Dataset statistics', '', 'Total records: {}'.format(stats['total']), '',
+             '## Labels by split', '']
+    rows = [[lbl] + [stats['label_split_counts'][lbl][s] for s in splits] +
+                [stats['label_counts'][lbl]] for lbl in stats['labels']]
+    rows.append(['**total**'] + [stats['split_counts'][s] for s in splits] + [stats['total']])
+    lines += _table(['label'] + splits + ['total'], rows)
+
+    lines += ['', '## Sources', '']
+    rows = [[name, x['records'], x['exclusive']] for (name, x) in sorted(stats['sources'].items())]
+    lines += _table(['source', 'records', 'only source'], rows)
+
+    for key, x in sorted(stats['scalars'].items()):
+        lines += ['', '## {}'.format(key), '', 'Fill rate: {:.1%}'.format(x['fill_rate']), '']
+        rows = []
+        for lbl in stats['labels']:
+            d = x['by_label'][lbl]
+            rows.append([lbl, d['count'], '{:.1%}'.format(d['fill_rate'])] +
+                        [_fmt(d.get(name)) for name in ['mean', 'std'] + [q for (q, _) in QUANTILES]])
+        lines += _table(['label', 'count', 'fill rate', 'mean', 'std'] + [q for (q, _) in QUANTILES], rows)
+    return '\n'.join(lines) + '\n'
+
+
+def write_report(stats, path):
+    """Write `stats` to `path` as Markdown if it ends in '.md', else JSON"""
+    with open(path, 'w') as f:
+        if path.endswith('.md'):
+            f.write(stats_to_markdown(stats))
+        else:
+            json.dump(stats, f, indent=2, sort_keys=True)
@@ -0,0 +1,62 @@
+from __future__ import print_function, division
+import json
+import unittest
+import dataset_stats
+import provenance
+from assemble_class_lists import VesselRecord, scalar_keys
+
+
+def make_combined(table):
+    a = table.bit('a')
+    b = table.bit('b')
+    records = [
+        VesselRecord('1', 'trawlers', 10.0, None, 100.0, None, 'Training', a | b),
+        VesselRecord('2', 'trawlers', 20.0, None, None, None, 'Test', a),
+        VesselRecord('3', 'trawlers', 30.0, 500.0, None, None, 'Training', b),
+        VesselRecord('4', 'cargo', None, None, None, None, 'Test', b),
+        VesselRecord('5', 'unknown', None, None, None, None, None, a),
+    ]
+    return {x.mmsi: x for x in records}
+
+
+class CheckStats(unittest.TestCase):
+
+    def setUp(self):
+        table = provenance.SourceTable()
+        self.stats = dataset_stats.compute_stats(make_combined(table), scalar_keys, table)
+
+    def test_counts(self):
+        stats = self.stats
+        self.assertEqual(stats['total'], 5)
+        self.assertEqual(stats['label_counts'], {'trawlers': 3, 'cargo': 1, 'unknown': 1})
+        self.assertEqual(stats['split_counts'], {'Training': 2, 'Test': 2, 'Unassigned': 1})
+        self.assertEqual(stats['label_split_counts']['trawlers'],
+                         {'Training': 2, 'Test': 1, 'Unassigned': 0})
+
+    def test_sources(self):
+        sources = self.stats['sources']
+        self.assertEqual(sources['a'], {'records': 3, 'exclusive': 2,
+                                        'labels': {'trawlers': 2, 'unknown': 1}})
+        self.assertEqual(sources['b'], {'records': 3, 'exclusive': 2,
+                                        'labels': {'trawlers': 2, 'cargo': 1}})
+
+    def test_scalars(self):
+        length = self.stats['scalars']['length']
+        self.assertAlmostEqual(length['fill_rate'], 0.6)
+        trawlers = length['by_label']['trawlers']
+        self.assertEqual(trawlers['count'], 3)
+        self.assertAlmostEqual(trawlers['mean'], 20.0)
+        self.assertAlmostEqual(trawlers['median'], 20.0)
+        self.assertAlmostEqual(trawlers['p25'], 15.0)
+        self.assertAlmostEqual(trawlers['max'], 30.0)
+        self.assertEqual(length['by_label']['cargo'], {'count': 0, 'fill_rate': 0.0})
+        self.assertAlmostEqual(self.stats['scalars']['tonnage']['by_label']['trawlers']['fill_rate'], 1 / 3)
+
+    def test_reports(self):
+        json.dumps(self.stats)
+        markdown = dataset_stats.stats_to_markdown(self.stats)
+        self.assertIn('| trawlers | 1 | 2 | 0 | 3 |', markdown)
+
+
+if __name__ == '__main__':
+    unittest.main()
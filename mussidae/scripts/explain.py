@@ -0,0 +1,173 @@
+"""Explain how individual MMSI were labelled and split
+
+Uses the index written by `assemble_class_lists.py --explain-index PATH`,
+so no source lists are reloaded:
+
+    python explain.py PATH 412413381 224103000
+
+For each mmsi this shows every raw row found for it (including rows that
+were rejected while loading), the converted label and scalars, how
+`combine_classes` and `combine_scalars` combined them, any corrections or
+`add_class` overrides, and how the split was decided. Decisions are those
+recorded while building the list, shown separately for each raw mmsi the
+pipeline combined rows under (raw mmsi that differ only by whitespace are
+not merged).
+"""
+from __future__ import print_function, division
+import argparse
+import json
+import numpy as np
+import mmsi_index
+
+
+def explain_scalar(values, result, alpha):
+    """Describe the `combine_scalars` decision that gave `result` for `values`"""
+    present = [x for x in values if x]
+    d = {'values': present, 'result': result}
+    if present:
+        mean = float(np.mean(present))
+        std = float(np.std(present))
+        d.update(mean=mean, std=std, limit=alpha * mean, rejected=(std > alpha * mean))
+    return d
+
+
+def explain_split(label, record, changes, meta, decision=None):
+    """Describe how the split of `record` was decided"""
+    if any(kind == 'added' for (kind, _) in changes):
+        return 'added by add_class with a random split: {}'.format(record['split'])
+    if record['split'] is None:
+        return "no split: label is 'unknown' and there are no scalar values"
+    count = meta['label_counts'].get(label, 0)
+    if label in meta['test_labels']:
+        if decision is None:
+            return '{}: {!r} ({} records) is eligible for Test'.format(record['split'], label, count)
+        start, stop = decision['test_ranks']
+        return ('{}: {!r} ({} records) is eligible for Test; rank {} of {} candidates in '
+                '{!r} split order, ranks {} to {} go to Test'.format(
+                    record['split'], label, count, decision['rank'], decision['candidates'],
+                    meta.get('split_scheme', 'legacy'), start, stop - 1))
+    return ('{}: {!r} ({} records) is not eligible for Test; only simple labels with '
+            'more than {} records are'.format(record['split'], label, count, meta['min_count']))
+
+
+def explain_key(key, rows, changes, record, decision, meta):
+    """Explain the record the pipeline built under raw mmsi `key`
+
+    Uses the decisions recorded while building it rather than recomputing
+    them, so this matches the output even when other raw mmsi strip to the
+    same value.
+
+    """
+    result = {'key': key, 'changes': changes, 'record': record}
+    label = None
+    if decision is not None:
+        labels = decision['label']['inputs']
+        label = decision['label']['result']
+        sub_labels = {y for x in labels if x for y in x.split('|')}
+        result['label'] = {'inputs': labels, 'result': label,
+                           'dropped': sorted(sub_labels - set(label.split('|')))}
+        result['scalars'] = {k: explain_scalar(decision['scalars'][k]['inputs'],
+                                               decision['scalars'][k]['result'], meta['alpha'])
+                                for k in meta['scalar_keys']}
+    if record is not None:
+        result['split'] = explain_split(label, record, changes, meta,
+                                        (decision or {}).get('split'))
+    elif any(kind == 'removed' for (kind, _) in changes):
+        result['split'] = 'not in output: removed as an incorrect mmsi'
+    else:
+        reasons = sorted({reason for (_, _, _, reason, _) in rows if reason})
+        result['split'] = 'not in output: every row was rejected while loading ({})'.format(
+            ', '.join(reasons))
+    return result
+
+
+def explain(index, mmsi):
+    """Explain the records for `mmsi` using an open `mmsi_index.MMSIIndex`
+
+    Returns:
+        dict describing the raw rows found for `mmsi` and, under 'combined',
+        the decisions, changes and final record for each raw mmsi ('key')
+        the pipeline combined rows under.
+
+    """
+    found = index.lookup(mmsi)
+    keys = []
+    for key in ([x[0] for x in found['rows']] + [x[0] for x in found['changes']] +
+                sorted(found['records'])):
+        if key not in keys:
+            keys.append(key)
+    result = {
+        'mmsi': found['mmsi'],
+        'scalar_keys': index.meta['scalar_keys'],
+        'rows': [{'key': key, 'source': source, 'row': row, 'raw': raw, 'rejected': reason,
+                  'converted': converted}
+                    for (key, source, row, raw, reason, converted) in found['rows']],
+        'combined': [explain_key(key,
+                                 [x[1:] for x in found['rows'] if x[0] == key],
+                                 [x[1:] for x in found['changes'] if x[0] == key],
+                                 found['records'].get(key), found['decisions'].get(key),
+                                 index.meta)
+                        for key in keys],
+    }
+    if not keys:
+        result['split'] = 'not in output: mmsi not found in any list'
+    return result
+
+
+def format_explanation(e):
+    """Render the output of `explain` as text"""
+    lines = ['MMSI {}'.format(e['mmsi'])]
+    if 'split' in e:
+        lines.append('  Split: {}'.format(e['split']))
+        return '\n'.join(lines)
+    lines.append('  Rows:')
+    for row in e['rows']:
+        lines.append('    {} row {}: {}'.format(row['source'], row['row'],
+                                                json.dumps(row['raw'], sort_keys=True)))
+        if row['rejected']:
+            lines.append('      rejected: {}'.format(row['rejected']))
+        else:
+            converted = row['converted']
+            parts = ['label {!r}'.format(converted['label'])]
+            parts += ['{}={}'.format(k, converted[k]) for k in e['scalar_keys']
+                      if converted[k] is not None]
+            lines.append('      ' + ', '.join(parts))
+    for c in e['combined']:
+        lines.append('  Combined as mmsi {}:'.format(json.dumps(c['key'])))
+        if 'label' in c:
+            label = c['label']
+            lines.append('    Label: {} -> {!r}'.format(label['inputs'], label['result']))
+            if label['dropped']:
+                lines.append('      dropped as less specific: {}'.format(', '.join(label['dropped'])))
+            lines.append('    Scalars:')
+            for key in e['scalar_keys']:
+                d = c['scalars'][key]
+                if not d['values']:
+                    continue
+                verdict = ('rejected, std {:.4g} > {:.4g}'.format(d['std'], d['limit'])
+                              if d['rejected'] else 'mean {:.4g}'.format(d['mean']))
+                lines.append('      {}: {} -> {}'.format(key, d['values'], verdict))
+        for kind, description in c['changes']:
+            lines.append('    {}: {}'.format(kind.capitalize(), description))
+        if c['record'] is not None:
+            lines.append('    Final: {}'.format(json.dumps(c['record'], sort_keys=True)))
+        lines.append('    Split: {}'.format(c['split']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Explain how vessels were labelled and split.')
+    parser.add_argument('index', help='Index written by assemble_class_lists.py --explain-index.')
+    parser.add_argument('mmsi', nargs='+')
+    parser.add_argument('--json', action='store_true', help='Print explanations as JSON.')
+    args = parser.parse_args()
+
+    index = mmsi_index.MMSIIndex(args.index)
+    try:
+        explanations = [explain(index, x) for x in args.mmsi]
+    finally:
+        index.close()
+    if args.json:
+        print(json.dumps(explanations, indent=2, sort_keys=True))
+    else:
+        print('\n\n'.join(format_explanation(x) for x in explanations))
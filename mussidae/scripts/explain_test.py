@@ -0,0 +1,104 @@
+from __future__ import print_function, division
+from collections import OrderedDict
+import os
+import shutil
+import tempfile
+import unittest
+import explain
+import mmsi_index
+import provenance
+from assemble_class_lists import VesselRecord, combine_fields, keys, output_keys, scalar_keys
+
+
+def converted(mmsi, label, length=None):
+    return {'mmsi': mmsi, 'label': label, 'length': length, 'engine_power': None,
+            'tonnage': None, 'crew_size': None}
+
+
+def combine(raw):
+    """Combine the kept rows of `raw` as `load_lists` and `combine_fields` would"""
+    mapping = {}
+    for name, rows in raw.items():
+        for _, _, reason, values in rows:
+            if reason is None:
+                lists = mapping.setdefault(values['mmsi'], [[] for _ in output_keys])
+                for i, key in enumerate(keys):
+                    lists[i].append(values[key])
+                lists[-2].append(None)
+                lists[-1].append(name)
+    decisions = {}
+    combine_fields({k: VesselRecord(*v) for (k, v) in mapping.items()},
+                   provenance.SourceTable(), decisions)
+    return decisions
+
+
+class CheckExplain(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'index.sqlite')
+        # '1' and '1 ' strip to the same mmsi but are combined separately
+        raw = OrderedDict()
+        raw['a'] = [(0, {'mmsi': '1', 'label': 'Trawler', 'length': '10'}, None,
+                        converted('1', 'trawlers', 10.0)),
+                    (1, {'mmsi': '2', 'label': 'Trawler'}, 'incorrect', None),
+                    (2, {'mmsi': '1', 'label': 'Trawler', 'length': '10.5'}, None,
+                        converted('1', 'trawlers', 10.5))]
+        raw['b'] = [(5, {'mmsi': '1 ', 'label': 'fishing', 'length': '20'}, None,
+                        converted('1 ', 'unknown_fishing', 20.0))]
+        changes = [('2', 'removed', 'listed in incorrect_mmsi.csv'),
+                   ('1', 'relabelled', 'trawlers -> gear (gear.csv)')]
+        records = {'1': {'mmsi': '1', 'label': 'gear', 'length': 10.25, 'engine_power': None,
+                         'tonnage': None, 'crew_size': None, 'split': 'Training',
+                         'source': 'a;gear.csv', 'imputed': []},
+                   '1 ': {'mmsi': '1 ', 'label': 'unknown_fishing', 'length': 20.0,
+                          'engine_power': None, 'tonnage': None, 'crew_size': None,
+                          'split': 'Training', 'source': 'b', 'imputed': []}}
+        decisions = combine(raw)
+        decisions['1']['split'] = {'rank': 17, 'candidates': 30, 'test_ranks': [15, 30]}
+        meta = {'label_counts': {'trawlers': 30, 'unknown_fishing': 1},
+                'test_labels': ['trawlers'], 'split_scheme': 'legacy',
+                'scalar_keys': scalar_keys, 'min_count': 20, 'alpha': 0.1}
+        mmsi_index.write_index(self.path, raw, changes, records, meta, decisions)
+        self.index = mmsi_index.MMSIIndex(self.path)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+    def test_explain(self):
+        e = explain.explain(self.index, '1')
+        self.assertEqual([(x['key'], x['source'], x['row']) for x in e['rows']],
+                         [('1', 'a', 0), ('1', 'a', 2), ('1 ', 'b', 5)])
+        self.assertEqual([x['key'] for x in e['combined']], ['1', '1 '])
+        first, second = e['combined']
+        self.assertEqual(first['label'], {'inputs': ['trawlers', 'trawlers'],
+                                          'result': 'trawlers', 'dropped': []})
+        length = first['scalars']['length']
+        self.assertEqual(length['values'], [10.0, 10.5])
+        self.assertFalse(length['rejected'])
+        self.assertAlmostEqual(length['result'], 10.25)
+        self.assertEqual(first['changes'], [('relabelled', 'trawlers -> gear (gear.csv)')])
+        self.assertEqual(first['record']['label'], 'gear')
+        self.assertIn('eligible for Test; rank 17 of 30', first['split'])
+        self.assertIn('ranks 15 to 29 go to Test', first['split'])
+        self.assertEqual(second['label']['result'], 'unknown_fishing')
+        self.assertEqual(second['scalars']['length']['result'], 20.0)
+        self.assertEqual(second['changes'], [])
+        self.assertIn('is not eligible for Test', second['split'])
+        text = explain.format_explanation(e)
+        self.assertIn('MMSI 1', text)
+        self.assertIn('Combined as mmsi "1 "', text)
+
+    def test_explain_missing(self):
+        e = explain.explain(self.index, '2')
+        self.assertEqual(e['rows'][0]['rejected'], 'incorrect')
+        self.assertEqual([x['split'] for x in e['combined']],
+                         ['not in output: removed as an incorrect mmsi'])
+        e = explain.explain(self.index, '3')
+        self.assertEqual(e['split'], 'not in output: mmsi not found in any list')
+        explain.format_explanation(e)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+"""Impute missing scalar attributes of combined vessel records
+
+Missing values are predicted from the other scalars of the same vessel
+using least-squares fits of log(target) against log(predictor). Fits are
+made per group, from most to least specific:
+
+  * label and provenance mask, so sources that share units or conventions
+    are fitted together,
+  * label,
+  * all records.
+
+A group's fit is only used if it has at least `MIN_FIT_SAMPLES` vessels.
+Values that still cannot be predicted are filled with the median of the
+vessel's label, if that label has at least `MIN_FIT_SAMPLES` observed
+values; otherwise they are left missing. Only observed values
+are ever used for fitting and prediction, so the result does not depend on
+the order in which scalars are imputed. Everything is computed with grouped
+numpy reductions, and the output is deterministic.
+"""
+from __future__ import print_function, division
+import numpy as np
+
+
+MIN_FIT_SAMPLES = 10
+
+
+def _group_fits(x, y, groups, n_groups):
+    """Least squares fit of y = a + b * x in each group
+
+    Returns:
+        (a, b, usable) arrays indexed by group.
+
+    """
+    n = np.bincount(groups, minlength=n_groups).astype(float)
+    sx = np.bincount(groups, weights=x, minlength=n_groups)
+    sy = np.bincount(groups, weights=y, minlength=n_groups)
+    sxx = np.bincount(groups, weights=x * x, minlength=n_groups)
+    sxy = np.bincount(groups, weights=x * y, minlength=n_groups)
+    denom = n * sxx - sx * sx
+    usable = (n >= MIN_FIT_SAMPLES) & (denom > 1e-9 * np.maximum(n * sxx, 1))
+    safe = np.where(usable, denom, 1.0)
+    b = np.where(usable, (n * sxy - sx * sy) / safe, 0.0)
+    a = np.where(usable, (sy - b * sx) / np.maximum(n, 1), 0.0)
+    return a, b, usable
+
+
+def _group_medians(values, groups, n_groups, min_samples=1):
+    """Median of the finite `values` in each group
+
+    Groups with fewer than `min_samples` finite values get NaN.
+
+    """
+    present = np.isfinite(values)
+    v = values[present]
+    g = groups[present]
+    counts = np.bincount(g, minlength=n_groups)
+    order = np.lexsort((v, g))
+    v = v[order]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    medians = np.full(n_groups, np.nan)
+    has = counts >= max(min_samples, 1)
+    lo = starts[has] + (counts[has] - 1) // 2
+    hi = starts[has] + counts[has] // 2
+    medians[has] = 0.5 * (v[lo] + v[hi])
+    return medians
+
+
+def _predictor_order(logs, target):
+    """Other scalars ordered by decreasing |correlation| with `target`"""
+    scores = []
+    for p in range(logs.shape[1]):
+        if p == target:
+            continue
+        both = np.isfinite(logs[:, p]) & np.isfinite(logs[:, target])
+        if both.sum() < MIN_FIT_SAMPLES:
+            continue
+        r = np.corrcoef(logs[both, p], logs[both, target])[0, 1]
+        if np.isfinite(r):
+            scores.append((-abs(r), p))
+    return [p for (_, p) in sorted(scores)]
+
+
+def impute_columns(values, label_ix, mask_ix):
+    """Impute missing entries in a scalar matrix
+
+    Args:
+        values : (n, k) float array
+            scalar values with NaN where missing
+        label_ix : (n,) int array
+            label group of each row
+        mask_ix : (n,) int array
+            provenance group of each row
+
+    Returns:
+        (filled, imputed) where `filled` is a copy of `values` with missing
+        entries predicted where possible and `imputed` is a boolean array
+        marking the predicted entries.
+
+    """
+    n, k = values.shape
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logs = np.where(values > 0, np.log(values), np.nan)
+    _, fine_ix = np.unique(label_ix * (mask_ix.max() + 1 if n else 1) + mask_ix,
+                           return_inverse=True)
+    levels = [fine_ix.reshape(-1), label_ix, np.zeros(n, dtype=int)]
+    filled = values.copy()
+    imputed = np.zeros([n, k], dtype=bool)
+    for t in range(k):
+        todo = ~np.isfinite(logs[:, t])
+        for p in _predictor_order(logs, t):
+            both = np.isfinite(logs[:, p]) & np.isfinite(logs[:, t])
+            for groups in levels:
+                n_groups = groups.max() + 1 if n else 0
+                a, b, usable = _group_fits(logs[both, p], logs[both, t],
+                                           groups[both], n_groups)
+                rows = todo & np.isfinite(logs[:, p]) & usable[groups]
+                g = groups[rows]
+                filled[rows, t] = np.exp(a[g] + b[g] * logs[rows, p])
+                imputed[rows, t] = True
+                todo &= ~rows
+        medians = _group_medians(values[:, t], label_ix, label_ix.max() + 1 if n else 0,
+                                 MIN_FIT_SAMPLES)
+        rows = todo & np.isfinite(medians[label_ix])
+        filled[rows, t] = medians[label_ix[rows]]
+        imputed[rows, t] = True
+    return filled, imputed
+
+
+def impute(combined, scalar_keys, curated=None):
+    """Fill missing scalars of combined records in place
+
+    Args:
+        combined : dict
+            map from mmsi to combined `VesselRecord`; records are replaced
+            by copies with imputed values filled in
+        scalar_keys : list of str
+            names of the scalar fields to impute
+        curated : dict, optional
+            map from mmsi to the keys a curator set, such as those from
+            `apply_corrections(corrected=...)`; these are never imputed,
+            even where the curator blanked the value.
+
+    Returns:
+        dict mapping each mmsi with imputed values to the list of keys that
+        were imputed.
+
+    """
+    mmsi = sorted(combined)
+    records = [combined[x] for x in mmsi]
+    values = np.array([[np.nan if (getattr(r, key) is None) else getattr(r, key)
+                            for key in scalar_keys] for r in records], dtype=float)
+    values = values.reshape(len(records), len(scalar_keys))
+    _, label_ix = np.unique(np.array([r.label for r in records], dtype=object).astype(str),
+                            return_inverse=True)
+    _, mask_ix = np.unique(np.array([r.source for r in records], dtype=object),
+                           return_inverse=True)
+    filled, imputed = impute_columns(values, label_ix.reshape(-1), mask_ix.reshape(-1))
+    rows = {x: i for (i, x) in enumerate(mmsi)}
+    for x, keys in (curated or {}).items():
+        if x in rows:
+            for key in keys:
+                if key in scalar_keys:
+                    imputed[rows[x], scalar_keys.index(key)] = False
+    result = {}
+    for i in np.flatnonzero(imputed.any(axis=1)):
+        keys = [key for (j, key) in enumerate(scalar_keys) if imputed[i, j]]
+        combined[mmsi[i]] = records[i]._replace(
+            **{key: float(filled[i, scalar_keys.index(key)]) for key in keys})
+        result[mmsi[i]] = keys
+    return result
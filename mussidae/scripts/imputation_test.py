@@ -0,0 +1,70 @@
+from __future__ import print_function, division
+import unittest
+import numpy as np
+import imputation
+from assemble_class_lists import VesselRecord, scalar_keys
+
+
+class CheckImputation(unittest.TestCase):
+
+    def test_group_fits(self):
+        x = np.arange(20, dtype=float)
+        groups = np.array([0] * 10 + [1] * 10)
+        y = np.where(groups == 0, 1 + 2 * x, 3 - x)
+        a, b, usable = imputation._group_fits(x, y, groups, 3)
+        np.testing.assert_allclose(a[:2], [1, 3])
+        np.testing.assert_allclose(b[:2], [2, -1])
+        self.assertEqual(list(usable), [True, True, False])
+
+    def test_group_medians(self):
+        values = np.array([1.0, 3.0, np.nan, 2.0, 10.0, 20.0])
+        groups = np.array([0, 0, 0, 0, 1, 1])
+        medians = imputation._group_medians(values, groups, 3)
+        np.testing.assert_allclose(medians[:2], [2.0, 15.0])
+        self.assertTrue(np.isnan(medians[2]))
+        medians = imputation._group_medians(values, groups, 3, min_samples=3)
+        np.testing.assert_allclose(medians[:1], [2.0])
+        self.assertTrue(np.isnan(medians[1:]).all())
+
+    def test_impute(self):
+        combined = {}
+        # tonnage = length ** 2 for trawlers with both values
+        for i in range(1, 21):
+            mmsi = str(i)
+            combined[mmsi] = VesselRecord(mmsi, 'trawlers', float(i), None, float(i * i), None, None, 1)
+        combined['30'] = VesselRecord('30', 'trawlers', 30.0, None, None, None, None, 1)
+        combined['31'] = VesselRecord('31', 'trawlers', None, None, None, None, None, 2)
+        combined['32'] = VesselRecord('32', 'cargo', None, None, None, None, None, 2)
+        # A single observation is too few to fill the label's other records
+        combined['33'] = VesselRecord('33', 'tug', 25.0, None, None, None, None, 3)
+        combined['34'] = VesselRecord('34', 'tug', None, None, None, None, None, 3)
+        imputed = imputation.impute(combined, scalar_keys)
+        self.assertEqual(imputed['30'], ['tonnage'])
+        self.assertAlmostEqual(combined['30'].tonnage, 900.0)
+        # No other scalars, so filled from the label medians
+        self.assertEqual(imputed['31'], ['length', 'tonnage'])
+        self.assertAlmostEqual(combined['31'].length, 11.0)
+        self.assertNotIn('32', imputed)
+        self.assertEqual(combined['32'].length, None)
+        self.assertNotIn('34', imputed)
+        self.assertEqual(combined['34'].length, None)
+        self.assertEqual(combined['1'].tonnage, 1.0)
+
+    def test_curated_not_imputed(self):
+        combined = {}
+        for i in range(1, 21):
+            mmsi = str(i)
+            combined[mmsi] = VesselRecord(mmsi, 'trawlers', float(i), None, float(i * i), None, None, 1)
+        # A curator blanked the tonnage of '30' and corrected the length of '31'
+        combined['30'] = VesselRecord('30', 'trawlers', 30.0, None, None, None, None, 1)
+        combined['31'] = VesselRecord('31', 'trawlers', 5.0, None, None, None, None, 1)
+        imputed = imputation.impute(combined, scalar_keys,
+                                    curated={'30': {'tonnage'}, '31': {'length'}, '99': {'length'}})
+        self.assertNotIn('30', imputed)
+        self.assertEqual(combined['30'].tonnage, None)
+        self.assertEqual(imputed['31'], ['tonnage'])
+        self.assertAlmostEqual(combined['31'].tonnage, 25.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
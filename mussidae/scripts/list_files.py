@@ -0,0 +1,115 @@
+"""Find, open and fingerprint (possibly compressed) list files
+
+Lists may be stored as .csv, .csv.gz, .csv.bz2 or .csv.xz and are
+decompressed while streaming. Shared by `assemble_class_lists.py` and
+`vessel_labelling/vessel_label_mapping.py`.
+"""
+from __future__ import print_function, division
+import bz2
+import gzip
+import hashlib
+import io
+import os
+import sys
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+compressed_openers = {'.gz': gzip.open, '.bz2': bz2.BZ2File}
+if lzma is not None:
+    compressed_openers['.xz'] = lzma.open
+
+list_suffixes = ['.csv', '.csv.gz', '.csv.bz2', '.csv.xz']
+
+
+def split_list_suffix(path):
+    """Split `path` into its base and one of `list_suffixes`
+
+    Returns (path, '') if `path` does not end with a list suffix.
+
+    """
+    for suffix in list_suffixes[::-1]:
+        if path.endswith(suffix):
+            return path[:-len(suffix)], suffix
+    return path, ''
+
+
+def find_list(directory, file_name):
+    """Return the path of `file_name` in `directory`, or of a compressed copy
+
+    'corrected_lengths.csv', for instance, is also found as
+    'corrected_lengths.csv.gz'. If neither exists the uncompressed path is
+    returned, so opening it raises the usual error.
+
+    """
+    path = os.path.join(directory, file_name)
+    if not os.path.exists(path):
+        base, suffix = split_list_suffix(path)
+        if suffix == '.csv':
+            for candidate in list_suffixes[1:]:
+                if os.path.exists(base + candidate):
+                    return base + candidate
+    return path
+
+
+class _UniversalLines(object):
+    """Iterate a binary stream by line, translating '\\r\\n' and '\\r' to '\\n'
+
+    Python 2 only offers universal newlines ('rU') for uncompressed files;
+    some lists (e.g. WorldwideSeismicVesselDatabase4Dec15) end lines with
+    a bare carriage return, which csv otherwise rejects.
+
+    """
+
+    def __init__(self, f, blocksize=1 << 16):
+        self._f = f
+        self._blocksize = blocksize
+
+    def __iter__(self):
+        pending = b''
+        for block in iter(lambda: self._f.read(self._blocksize), b''):
+            pending += block
+            # Hold back a final '\r' in case the next block starts with '\n'
+            end = len(pending) - 1 if pending.endswith(b'\r') else len(pending)
+            lines = pending[:end].replace(b'\r\n', b'\n').replace(b'\r', b'\n').split(b'\n')
+            pending = lines.pop() + pending[end:]
+            for line in lines:
+                yield line + b'\n'
+        if pending:
+            yield pending.replace(b'\r', b'\n')
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_list(path):
+    """Open a list for reading as csv, decompressing while streaming"""
+    ext = os.path.splitext(path)[1]
+    if ext == '.xz' and lzma is None:
+        raise IOError('reading {} requires the lzma module (backports.lzma on Python 2)'.format(path))
+    if ext not in compressed_openers:
+        return open(path, 'rU')
+    f = compressed_openers[ext](path, 'rb')
+    if sys.version_info[0] >= 3:
+        return io.TextIOWrapper(f, newline='')
+    return _UniversalLines(f)
+
+
+def file_digest(path, blocksize=1 << 20):
+    """Return the SHA-1 hex digest of the file at `path`"""
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
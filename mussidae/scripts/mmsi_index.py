@@ -0,0 +1,127 @@
+"""Persisted per-mmsi index of raw list rows and pipeline decisions
+
+The index is a SQLite database keyed by (stripped) mmsi, so looking up a
+handful of vessels does not require reloading any of the source lists.
+Each entry also keeps the raw mmsi ('key') the pipeline combined it under,
+since raw mmsi that only differ by whitespace are combined separately.
+"""
+from __future__ import print_function, division
+import json
+import os
+import sqlite3
+
+
+SCHEMA = '''
+CREATE TABLE rows (mmsi TEXT, key TEXT, source TEXT, row INTEGER, raw TEXT, reason TEXT,
+                   converted TEXT);
+CREATE TABLE changes (mmsi TEXT, key TEXT, seq INTEGER, kind TEXT, description TEXT);
+CREATE TABLE records (mmsi TEXT, key TEXT, record TEXT);
+CREATE TABLE decisions (mmsi TEXT, key TEXT, decision TEXT);
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE INDEX rows_mmsi ON rows (mmsi);
+CREATE INDEX changes_mmsi ON changes (mmsi);
+CREATE INDEX records_mmsi ON records (mmsi);
+CREATE INDEX decisions_mmsi ON decisions (mmsi);
+'''
+
+
+def _text(value):
+    """Return `value` as unicode text, decoding byte strings as utf-8"""
+    if value is None or isinstance(value, type(u'')):
+        return value
+    return value.decode('utf-8', 'replace')
+
+
+def _dumps(d):
+    if d is None:
+        return None
+    return json.dumps({k: _text(v) if isinstance(v, (bytes, type(u''))) else v
+                          for (k, v) in d.items()}, sort_keys=True)
+
+
+def write_index(path, raw, changes, records, meta, decisions=None):
+    """Write an index to `path`, replacing any existing file
+
+    Args:
+        raw : dict
+            raw rows by source name, as gathered by `load_lists(raw=...)`;
+            pass an OrderedDict to keep sources in load order
+        changes : list
+            (mmsi, kind, description) tuples from `apply_corrections` and
+            `add_class`, in the order they were made
+        records : dict
+            map from mmsi to the final record as a dict
+        meta : dict
+            JSON serializable values describing the run
+        decisions : dict, optional
+            map from mmsi to JSON serializable decisions made while
+            building its record, such as those from
+            `combine_fields(decisions=...)`
+
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    try:
+        conn.executescript(SCHEMA)
+        conn.executemany('INSERT INTO rows VALUES (?, ?, ?, ?, ?, ?, ?)',
+            ((_text(values['mmsi'].strip()), _text(values['mmsi']), _text(name), row,
+                    _dumps(values), reason, _dumps(converted))
+                for (name, rows) in raw.items()
+                for (row, values, reason, converted) in rows))
+        conn.executemany('INSERT INTO changes VALUES (?, ?, ?, ?, ?)',
+            ((_text(mmsi.strip()), _text(mmsi), i, kind, _text(description))
+                for (i, (mmsi, kind, description)) in enumerate(changes)))
+        conn.executemany('INSERT INTO records VALUES (?, ?, ?)',
+            ((_text(mmsi.strip()), _text(mmsi), _dumps(record))
+                for (mmsi, record) in records.items()))
+        conn.executemany('INSERT INTO decisions VALUES (?, ?, ?)',
+            ((_text(mmsi.strip()), _text(mmsi), json.dumps(decision, sort_keys=True))
+                for (mmsi, decision) in (decisions or {}).items()))
+        conn.executemany('INSERT INTO meta VALUES (?, ?)',
+            ((key, json.dumps(value)) for (key, value) in meta.items()))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+class MMSIIndex(object):
+    """Read access to an index written by `write_index`"""
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise IOError('no index at {}'.format(path))
+        self.conn = sqlite3.connect(path)
+        self.meta = {k: json.loads(v) for (k, v) in self.conn.execute('SELECT key, value FROM meta')}
+
+    def close(self):
+        self.conn.close()
+
+    def lookup(self, mmsi):
+        """Return everything recorded for `mmsi`
+
+        Returns:
+            dict with 'rows' (key, source, row, raw, reason, converted) in
+            load order, 'changes' (key, kind, description) in the order they
+            were applied, 'records' mapping each key to its final record
+            and 'decisions' mapping each key to the decisions made while
+            building it. There is normally one key; more only if raw mmsi
+            differ by whitespace.
+
+        """
+        mmsi = mmsi.strip()
+        rows = [(key, source, row, json.loads(raw), reason, converted and json.loads(converted))
+                    for (key, source, row, raw, reason, converted) in self.conn.execute(
+                        'SELECT key, source, row, raw, reason, converted FROM rows '
+                        'WHERE mmsi = ? ORDER BY rowid', (mmsi,))]
+        changes = list(self.conn.execute(
+            'SELECT key, kind, description FROM changes WHERE mmsi = ? ORDER BY seq', (mmsi,)))
+        records = {key: json.loads(x) for (key, x) in self.conn.execute(
+            'SELECT key, record FROM records WHERE mmsi = ?', (mmsi,))}
+        decisions = {key: json.loads(x) for (key, x) in self.conn.execute(
+            'SELECT key, decision FROM decisions WHERE mmsi = ?', (mmsi,))}
+        return {'mmsi': mmsi,
+                'rows': rows,
+                'changes': changes,
+                'records': records,
+                'decisions': decisions}
@@ -0,0 +1,119 @@
+"""Normalized, memory-mappable copies of the source lists
+
+Each source list is parsed once into a directory of columns saved with
+`np.save`, so later runs (of this pipeline or of
+`vessel_labelling/vessel_label_mapping.py`) read typed columns, memory
+mapped, instead of parsing the csv again. A store looks like:
+
+    STORE/index.json                 one entry per source, see `write_source`
+    STORE/<source name>/mmsi.npy     raw mmsi, as in the csv
+    STORE/<source name>/raw_label.npy
+    STORE/<source name>/label.npy    label after the source's mappings
+    STORE/<source name>/<scalar>.npy converted scalars, NaN where missing
+    STORE/<source name>/row.npy      row number in the csv (provenance)
+
+Text columns are fixed width byte strings (utf-8 on Python 3). An entry is
+only reused while the csv digest, headers and mappings it was built from
+match the manifest, so each list is parsed again only when it changes.
+"""
+from __future__ import print_function, division
+import json
+import os
+import sys
+import numpy as np
+
+
+# Increase when the meaning of the columns changes to rebuild every store.
+VERSION = 1
+
+INDEX_NAME = 'index.json'
+
+TEXT_COLUMNS = ['mmsi', 'raw_label', 'label']
+
+
+def encode_text(values):
+    """Return `values` as a fixed width byte string array"""
+    if sys.version_info[0] >= 3:
+        values = [x.encode('utf-8') for x in values]
+    return np.array(values, dtype=bytes) if values else np.zeros(0, dtype='S1')
+
+
+def decode_text(array):
+    """Return the strings in a byte string array as a list"""
+    values = array.tolist()
+    if sys.version_info[0] >= 3:
+        values = [x.decode('utf-8') for x in values]
+    return values
+
+
+def read_index(store):
+    """Return the index of `store`, empty if there is none yet"""
+    path = os.path.join(store, INDEX_NAME)
+    if not os.path.exists(path):
+        return {'version': VERSION, 'sources': {}}
+    with open(path) as f:
+        index = json.load(f)
+    if index.get('version') != VERSION:
+        return {'version': VERSION, 'sources': {}}
+    return index
+
+
+def write_index(store, index):
+    """Replace the index of `store`"""
+    path = os.path.join(store, INDEX_NAME)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def is_current(entry, source):
+    """Whether an index entry was built from manifest entry `source`"""
+    return (entry is not None and
+            all(entry.get(k) == source[k] for k in ('csv', 'sha1', 'headers', 'mappings')))
+
+
+def write_source(store, source, columns):
+    """Save the columns of one source
+
+    Args:
+        store : str
+            directory of the store
+        source : dict
+            manifest entry the columns were built from
+        columns : dict
+            lists of values by column name; text columns hold strings,
+            the others numbers (None for missing)
+
+    Returns:
+        index entry for the source.
+
+    """
+    directory = os.path.join(store, source['name'])
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    for name, values in columns.items():
+        if name in TEXT_COLUMNS:
+            array = encode_text(values)
+        elif name == 'row':
+            array = np.array(values, dtype=np.int32)
+        else:
+            array = np.array([np.nan if (x is None) else x for x in values], dtype=float)
+        np.save(os.path.join(directory, name + '.npy'), array)
+    entry = {k: source[k] for k in ('name', 'csv', 'sha1', 'headers', 'mappings')}
+    entry['rows'] = len(columns['row'])
+    entry['columns'] = sorted(columns)
+    return entry
+
+
+def read_source(store, entry):
+    """Return the columns of a source by name, memory mapped
+
+    Text columns are still byte strings; see `decode_text`.
+
+    """
+    directory = os.path.join(store, entry['name'])
+    # Empty arrays cannot be memory mapped.
+    mmap_mode = 'r' if entry['rows'] else None
+    return {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode)
+                for name in entry['columns']}
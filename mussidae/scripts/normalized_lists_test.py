@@ -0,0 +1,43 @@
+from __future__ import print_function, division
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import normalized_lists
+
+
+class CheckNormalizedLists(unittest.TestCase):
+
+    def setUp(self):
+        self.store = tempfile.mkdtemp()
+        self.source = {'name': 'a list', 'csv': 'a list.csv', 'sha1': 'abc', 'size': 10,
+                       'headers': {'mmsi': 'MMSI', 'label': 'type'}, 'mappings': {'x': 'cargo'}}
+
+    def tearDown(self):
+        shutil.rmtree(self.store)
+
+    def test_round_trip(self):
+        columns = {'mmsi': [' 1', '22'], 'raw_label': ['x', ''], 'label': ['cargo', ''],
+                   'length': [10.5, None], 'row': [0, 1]}
+        entry = normalized_lists.write_source(self.store, self.source, columns)
+        normalized_lists.write_index(self.store, {'version': normalized_lists.VERSION,
+                                                  'sources': {'a list': entry}})
+        entry = normalized_lists.read_index(self.store)['sources']['a list']
+        self.assertTrue(normalized_lists.is_current(entry, self.source))
+        self.assertFalse(normalized_lists.is_current(entry, dict(self.source, sha1='abd')))
+        read = normalized_lists.read_source(self.store, entry)
+        self.assertEqual(normalized_lists.decode_text(read['mmsi']), [' 1', '22'])
+        self.assertEqual(normalized_lists.decode_text(read['label']), ['cargo', ''])
+        self.assertEqual(read['length'][0], 10.5)
+        self.assertTrue(np.isnan(read['length'][1]))
+        self.assertEqual(read['row'].tolist(), [0, 1])
+
+    def test_empty_source(self):
+        columns = {'mmsi': [], 'raw_label': [], 'label': [], 'row': []}
+        entry = normalized_lists.write_source(self.store, self.source, columns)
+        read = normalized_lists.read_source(self.store, entry)
+        self.assertEqual(normalized_lists.decode_text(read['mmsi']), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+"""Stable MMSI hashing and split coordination for partitioned runs
+
+Records are assigned to partitions by a hash of the (stripped) mmsi, so the
+partition of a record does not depend on the process that loaded it.
+
+Two split schemes are supported (see `assemble_class_lists.assign_splits`):
+
+  * 'legacy' shuffles all mmsi in the order earlier releases held them
+    and stratifies the candidates with a 2-fold `StratifiedKFold`. Both
+    single process and partitioned runs reproduce that order with
+    `legacy_order` from the position at which each mmsi was first loaded,
+    so the coordinator needs (position, mmsi, label) for every record.
+
+  * 'hash-v1' orders the candidates of each label by `split_key` and puts
+    the first `quota` in Test, where the quotas are those a 2-fold
+    `StratifiedKFold` gives for the label counts. A partitioned run only
+    exchanges label counts, per-label histograms of the keys
+    (`key_histograms`) and the keys in the histogram bucket where each
+    label's quota falls (`boundary_keys`).
+"""
+from __future__ import print_function, division
+from collections import Counter
+import hashlib
+import numpy as np
+from sklearn.model_selection import StratifiedKFold
+
+
+SPLIT_SCHEMES = ['legacy', 'hash-v1']
+
+DEFAULT_SPLIT_SCHEME = 'legacy'
+
+# Keys are bucketed by their top bits when partitions share histograms.
+HISTOGRAM_BITS = 8
+
+
+def _as_bytes(text):
+    return text if isinstance(text, bytes) else text.encode('utf-8')
+
+
+def _digest(data):
+    return int(hashlib.sha1(data).hexdigest()[:16], 16)
+
+
+def partition_of(mmsi, n_partitions):
+    """Return the partition in range(n_partitions) that `mmsi` belongs to"""
+    return _digest(_as_bytes(mmsi.strip())) % n_partitions
+
+
+def split_key(mmsi, seed):
+    """Sort key ordering the Test candidates for `seed` ('hash-v1')"""
+    return (_digest(_as_bytes('{}:'.format(seed)) + _as_bytes(mmsi.strip())), mmsi)
+
+
+def legacy_order(records):
+    """Reproduce the order earlier releases iterated combined records in
+
+    Args:
+        records : list
+            (first position, mmsi, kept) for every mmsi loaded in any
+            partition, where the position is (source index, csv row) of the
+            first row loaded for the mmsi and `kept` is False if its rows
+            were rejected as 'incorrect' while loading or it was later
+            removed by `apply_corrections`.
+
+    The combined dict of earlier releases was built by inserting mmsi
+    (including incorrect ones) in the order they were first loaded, copied
+    once by `combine_fields` and then had removed mmsi deleted. On Python 2
+    the iteration order depends on that history; replaying it on plain
+    dicts gives the same order on any Python version.
+
+    """
+    loaded = {}
+    for _, mmsi, _ in sorted(records, key=lambda x: tuple(x[0])):
+        loaded[mmsi] = None
+    combined = {}
+    for mmsi in loaded:
+        combined[mmsi] = None
+    for _, mmsi, kept in records:
+        if not kept:
+            del combined[mmsi]
+    return list(combined)
+
+
+def stratified_quotas(label_counts, test_labels):
+    """Number of candidates of each label to put in the Test split
+
+    Args:
+        label_counts : dict
+            number of records per label
+        test_labels : set
+            labels eligible for Test
+
+    Returns:
+        dict mapping each of `test_labels` to the size of its share of the
+        first fold of a 2-fold `StratifiedKFold`; this only depends on the
+        counts, not on the order of the candidates.
+
+    """
+    labels = sorted(test_labels)
+    if not labels:
+        return {}
+    y = np.repeat(np.array(labels, dtype=object), [label_counts[x] for x in labels])
+    folder = StratifiedKFold(n_splits=2)
+    test_indices = next(folder.split(np.zeros(len(y)), y))[1]
+    counts = Counter(y[test_indices])
+    return {x: counts[x] for x in labels}
+
+
+def candidate_keys(combined, seed, labels):
+    """Sorted `split_key`s of the records in `combined` with one of `labels`
+
+    Returns:
+        dict mapping each label to the sorted keys of its records.
+
+    """
+    keys = {x: [] for x in labels}
+    for mmsi, record in combined.items():
+        if record.label in keys:
+            keys[record.label].append(split_key(mmsi, seed))
+    for x in keys.values():
+        x.sort()
+    return keys
+
+
+def _bucket(key):
+    return key[0] >> (64 - HISTOGRAM_BITS)
+
+
+def key_histograms(keys):
+    """Count the keys of each label in each of 2 ** HISTOGRAM_BITS buckets"""
+    return {label: np.bincount([_bucket(x) for x in values],
+                               minlength=1 << HISTOGRAM_BITS).tolist()
+                for (label, values) in keys.items()}
+
+
+def boundaries(histograms, quotas):
+    """Find the bucket where each label's quota falls
+
+    Args:
+        histograms : list of dict
+            `key_histograms` of each partition
+        quotas : dict
+            global number of Test records per label
+
+    Returns:
+        dict mapping each label to (bucket, remainder): every candidate in
+        an earlier bucket goes to Test, as do the first `remainder`
+        candidates (over all partitions) in the bucket itself.
+
+    """
+    result = {}
+    for label, quota in quotas.items():
+        total = np.zeros(1 << HISTOGRAM_BITS, dtype=int)
+        for x in histograms:
+            if label in x:
+                total += x[label]
+        if not quota:
+            result[label] = (-1, 0)
+            continue
+        cumulative = np.cumsum(total)
+        bucket = int(np.searchsorted(cumulative, quota))
+        below = int(cumulative[bucket - 1]) if bucket else 0
+        result[label] = (bucket, quota - below)
+    return result
+
+
+def boundary_keys(keys, bounds):
+    """The sorted keys of each label that fall in its boundary bucket"""
+    return {label: [x for x in keys.get(label, []) if _bucket(x) == bucket]
+                for (label, (bucket, _)) in bounds.items()}
+
+
+def partition_quotas(histograms, keys, bounds):
+    """Share the global quotas between partitions
+
+    Args:
+        histograms : list of dict
+            `key_histograms` of each partition
+        keys : list of dict
+            `boundary_keys` of each partition
+        bounds : dict
+            result of `boundaries`
+
+    Returns:
+        list with, for each partition, a dict of the number of its
+        candidates of each label that are among the label's first
+        `quota` candidates over all partitions.
+
+    """
+    result = [{} for _ in histograms]
+    for label, (bucket, remainder) in bounds.items():
+        for i, x in enumerate(histograms):
+            result[i][label] = int(sum(x.get(label, [])[:max(bucket, 0)]))
+        merged = sorted((tuple(key), i) for (i, x) in enumerate(keys)
+                            for key in x.get(label, []))
+        for _, i in merged[:remainder]:
+            result[i][label] += 1
+    return result
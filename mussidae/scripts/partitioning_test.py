@@ -0,0 +1,84 @@
+from __future__ import print_function, division
+import unittest
+import partitioning
+from assemble_class_lists import VesselRecord, assign_splits
+
+
+def make_combined(n):
+    labels = ['cargo', 'trawlers', 'tug']
+    return {str(100000 + i): VesselRecord(str(100000 + i), labels[i % 3], 10.0, None, None, None,
+                                          None, 1)
+                for i in range(n)}
+
+
+class CheckPartitioning(unittest.TestCase):
+
+    def test_partition_of(self):
+        self.assertEqual(partitioning.partition_of(' 123 ', 7),
+                         partitioning.partition_of('123', 7))
+        parts = {partitioning.partition_of(str(x), 4) for x in range(100)}
+        self.assertEqual(parts, {0, 1, 2, 3})
+
+    def test_stratified_quotas(self):
+        quotas = partitioning.stratified_quotas({'cargo': 41, 'tug': 30, 'gear': 5},
+                                                {'cargo', 'tug'})
+        self.assertEqual(sorted(quotas), ['cargo', 'tug'])
+        self.assertTrue(20 <= quotas['cargo'] <= 21)
+        self.assertEqual(quotas['tug'], 15)
+
+    def test_legacy_order(self):
+        mmsi = [str(100000 + 7 * i) for i in range(200)]
+        loaded = {}
+        for x in mmsi:
+            loaded[x] = None
+        combined = dict(loaded)
+        removed = set(mmsi[::9])
+        for x in removed:
+            del combined[x]
+        records = [((0, i), x, x not in removed) for (i, x) in enumerate(mmsi)]
+        records.reverse()
+        self.assertEqual(partitioning.legacy_order(records), list(combined))
+
+    def test_legacy_is_default(self):
+        combined = make_combined(150)
+        assign_splits(combined)
+        legacy = make_combined(150)
+        decisions = {}
+        assign_splits(legacy, scheme='legacy', decisions=decisions)
+        self.assertEqual(combined, legacy)
+        for mmsi, d in decisions.items():
+            start, stop = d['test_ranks']
+            self.assertEqual(stop, d['candidates'])
+            self.assertEqual(combined[mmsi].split == 'Test', start <= d['rank'] < stop)
+        with self.assertRaises(ValueError):
+            assign_splits(make_combined(10), scheme='hash-v0')
+
+    def test_partitioned_splits_match(self):
+        combined = make_combined(150)
+        decisions = {}
+        assign_splits(combined, scheme='hash-v1', decisions=decisions)
+        parts = [{} for _ in range(3)]
+        for mmsi, record in make_combined(150).items():
+            parts[partitioning.partition_of(mmsi, 3)][mmsi] = record
+        quotas = partitioning.stratified_quotas({'cargo': 50, 'trawlers': 50, 'tug': 50},
+                                                {'cargo', 'trawlers', 'tug'})
+        keys = [partitioning.candidate_keys(x, 4321, quotas) for x in parts]
+        histograms = [partitioning.key_histograms(x) for x in keys]
+        bounds = partitioning.boundaries(histograms, quotas)
+        boundary_keys = [partitioning.boundary_keys(x, bounds) for x in keys]
+        shares = partitioning.partition_quotas(histograms, boundary_keys, bounds)
+        for label, quota in quotas.items():
+            self.assertEqual(sum(x[label] for x in shares), quota)
+        merged = {}
+        for part, share in zip(parts, shares):
+            assign_splits(part, scheme='hash-v1', quotas=share)
+            merged.update(part)
+        self.assertEqual(merged, combined)
+        self.assertEqual(sum(x.split == 'Test' for x in combined.values()), 75)
+        for mmsi, d in decisions.items():
+            start, stop = d['test_ranks']
+            self.assertEqual(combined[mmsi].split == 'Test', start <= d['rank'] < stop)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+"""Record provenance as bitsets over an interned table of source names
+
+Each combined record stores the sources supporting it as an integer whose
+bit `i` is set if source `i` of a `SourceTable` contributed to it. The
+';'-separated string form is only produced when rendering for output: the
+sorted source names followed by any appended names (see
+`SourceTable.append`) in the order they were appended, so it does not
+depend on what else the table was used for.
+"""
+from __future__ import print_function, division
+import numpy as np
+
+
+WORD_BITS = 64
+
+
+class SourceTable(object):
+    """Intern source names, assigning each a bit in a provenance mask"""
+
+    def __init__(self, names=()):
+        self._names = []
+        self._bits = {}
+        self._appended = []
+        for name in names:
+            self.bit(name)
+
+    def __len__(self):
+        return len(self._names)
+
+    @property
+    def names(self):
+        return list(self._names)
+
+    def index(self, name):
+        """Return the bit index of `name`, interning it if new"""
+        if name not in self._bits:
+            self._bits[name] = len(self._names)
+            self._names.append(name)
+        return self._bits[name]
+
+    def lookup(self, name):
+        """Return the bit index of `name`, which must already be interned"""
+        if name not in self._bits:
+            raise KeyError('unknown source {!r}; known sources are {}'.format(
+                name, ', '.join(self._names) or 'none'))
+        return self._bits[name]
+
+    def append(self, name):
+        """Return the bit for `name`, rendered after the other names
+
+        For sources that are applied on top of the combined lists, such as
+        `add_class` files, which were appended to the source string.
+
+        """
+        if name not in self._appended:
+            self._appended.append(name)
+        return self.bit(name)
+
+    def bit(self, name):
+        """Return the mask with only the bit for `name` set"""
+        return 1 << self.index(name)
+
+    def mask(self, names):
+        """Return the mask with the bits for all of `names` set"""
+        result = 0
+        for name in names:
+            result |= self.bit(name)
+        return result
+
+    def decode(self, mask):
+        """Return the names of the sources set in `mask` in interning order"""
+        names = []
+        i = 0
+        while mask:
+            if mask & 1:
+                names.append(self._names[i])
+            mask >>= 1
+            i += 1
+        return names
+
+    def render(self, mask):
+        """Return `mask` as a ';'-separated string of names
+
+        Names are sorted, except that appended names come last in the
+        order they were appended.
+
+        """
+        names = self.decode(mask)
+        appended = [x for x in self._appended if x in names]
+        return ';'.join(sorted(x for x in names if x not in appended) + appended)
+
+
+class ProvenanceIndex(object):
+    """Vectorized provenance queries over combined records
+
+    Args:
+        combined : dict
+            map from mmsi to a record whose `source` is a provenance mask
+        source_table : SourceTable
+            table the masks were built with
+
+    Masks are packed into an (n_records, n_words) uint64 array so that
+    set-style queries are evaluated for all records at once.
+
+    """
+
+    def __init__(self, combined, source_table):
+        self.source_table = source_table
+        self.mmsi = sorted(combined)
+        self.n_words = max(1, -(-len(source_table) // WORD_BITS))
+        masks = [combined[x].source for x in self.mmsi]
+        self.words = self._pack(masks)
+
+    def _pack(self, masks):
+        words = np.zeros([len(masks), self.n_words], dtype=np.uint64)
+        word_mask = (1 << WORD_BITS) - 1
+        for w in range(self.n_words):
+            shift = w * WORD_BITS
+            words[:, w] = [(m >> shift) & word_mask for m in masks]
+        return words
+
+    def _query(self, names):
+        mask = 0
+        for name in names:
+            mask |= 1 << self.source_table.lookup(name)
+        return self._pack([mask])[0]
+
+    def _select(self, selected):
+        return [self.mmsi[i] for i in np.flatnonzero(selected)]
+
+    def membership(self, name):
+        """Return a boolean array marking records supported by `name`"""
+        i = self.source_table.lookup(name)
+        word = self.words[:, i // WORD_BITS]
+        return ((word >> np.uint64(i % WORD_BITS)) & np.uint64(1)).astype(bool)
+
+    def any_of(self, names):
+        """MMSI supported by at least one of `names`"""
+        q = self._query(names)
+        return self._select((self.words & q).any(axis=1))
+
+    def all_of(self, names):
+        """MMSI supported by every one of `names`"""
+        q = self._query(names)
+        return self._select(((self.words & q) == q).all(axis=1))
+
+    def only(self, names):
+        """MMSI supported by some of `names` and by no other source"""
+        q = self._query(names)
+        inside = (self.words & q).any(axis=1)
+        outside = (self.words & ~q).any(axis=1)
+        return self._select(inside & ~outside)
+
+    def leave_one_out(self):
+        """Impact of removing each source in turn
+
+        Returns:
+            dict mapping each source name to the number of records it
+            supports ('records') and the number that would lose all support
+            without it ('dropped').
+
+        """
+        names = self.source_table.names
+        members = [self.membership(name) for name in names]
+        n_sources = np.zeros(len(self.mmsi), dtype=int)
+        for m in members:
+            n_sources += m
+        sole = (n_sources == 1)
+        return {name: {'records': int(m.sum()), 'dropped': int((m & sole).sum())}
+                for (name, m) in zip(names, members)}
@@ -0,0 +1,61 @@
+from __future__ import print_function, division
+import unittest
+import provenance
+from assemble_class_lists import VesselRecord
+
+
+class CheckSourceTable(unittest.TestCase):
+
+    def test_masks(self):
+        table = provenance.SourceTable(['b', 'a'])
+        mask = table.mask(['a', 'c'])
+        self.assertEqual(mask, 0b110)
+        self.assertEqual(table.decode(mask), ['a', 'c'])
+        self.assertEqual(table.render(mask | table.bit('b')), 'a;b;c')
+        self.assertEqual(table.render(0), '')
+        self.assertEqual(table.lookup('c'), 2)
+        with self.assertRaises(KeyError):
+            table.lookup('d')
+
+    def test_render_order(self):
+        table = provenance.SourceTable(['zeta'])
+        mask = table.mask(['alpha', 'zeta'])
+        self.assertEqual(table.render(mask), 'alpha;zeta')
+        mask |= table.append('gear.csv') | table.append('bunkers.csv')
+        self.assertEqual(table.render(mask), 'alpha;zeta;gear.csv;bunkers.csv')
+        self.assertEqual(table.render(table.bit('bunkers.csv')), 'bunkers.csv')
+
+
+class CheckProvenanceIndex(unittest.TestCase):
+
+    def setUp(self):
+        # Enough sources that masks span more than one word.
+        self.table = provenance.SourceTable(['s{}'.format(i) for i in range(70)])
+        m = self.table.mask
+        sources = {'1': m(['s0']), '2': m(['s0', 's69']), '3': m(['s69']),
+                   '4': m(['s1', 's2', 's69'])}
+        combined = {k: VesselRecord(k, 'cargo', None, None, None, None, None, v)
+                        for (k, v) in sources.items()}
+        self.index = provenance.ProvenanceIndex(combined, self.table)
+
+    def test_queries(self):
+        self.assertEqual(self.index.any_of(['s0', 's1']), ['1', '2', '4'])
+        self.assertEqual(self.index.all_of(['s0', 's69']), ['2'])
+        self.assertEqual(self.index.only(['s0', 's69']), ['1', '2', '3'])
+        self.assertEqual(self.index.only(['s69']), ['3'])
+
+    def test_leave_one_out(self):
+        impact = self.index.leave_one_out()
+        self.assertEqual(impact['s0'], {'records': 2, 'dropped': 1})
+        self.assertEqual(impact['s69'], {'records': 3, 'dropped': 1})
+        self.assertEqual(impact['s5'], {'records': 0, 'dropped': 0})
+
+    def test_unknown_source(self):
+        with self.assertRaises(KeyError):
+            self.index.any_of(['s0', 'missing'])
+        with self.assertRaises(KeyError):
+            self.index.membership('missing')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+"""Pairwise agreement between source lists
+
+For every pair of sources this counts the MMSI they share, how many of the
+shared MMSI both label and whether those labels agree, and how their scalar
+values differ. Two labels agree if `combine_classes` merges them into one of
+the two (for instance 'trawlers' and 'unknown_fishing'); otherwise combining
+them would produce a joint label, which is counted as a conflict.
+
+Everything is computed from sparse MMSI x source matrices, so the cost grows
+with the number of (mmsi, source) entries rather than with the number of
+source pairs. Run as a script to write the matrix for the current lists:
+
+    python source_agreement.py agreement.csv
+    python source_agreement.py agreement.csv --conflicts "Problem Vessels 2" clav_v10_processed
+"""
+from __future__ import print_function, division
+import argparse
+import csv
+import logging
+import os
+import numpy as np
+from scipy import sparse
+from assemble_class_lists import (combine_classes, scalar_keys, load_lists, read_manifest,
+                                  compile_mmsi_filter, MANIFEST_NAME)
+
+
+def _source_entries(raw):
+    """Collapse a loaded mapping to one label and mean scalars per (mmsi, source)"""
+    entries = {}
+    for mmsi, record in raw.items():
+        for i, name in enumerate(record.source):
+            entry = entries.setdefault((mmsi, name), ([], {k: [] for k in scalar_keys}))
+            entry[0].append(record.label[i])
+            for key in scalar_keys:
+                value = getattr(record, key)[i]
+                if value is not None and value > 0:
+                    entry[1][key].append(value)
+    return entries
+
+
+class SourceAgreement(object):
+    """Source x source agreement statistics
+
+    Args:
+        raw : dict
+            mapping returned by `load_lists`, before `combine_fields`
+
+    Attributes:
+        names : list of str
+            source names, indexing the rows and columns of every matrix
+        overlap : (m, m) int array
+            number of MMSI in both sources
+        labelled : (m, m) int array
+            number of shared MMSI labelled by both sources
+        agree, conflict : (m, m) int arrays
+            split of `labelled` into agreeing and conflicting labels
+        scalars : dict
+            for each scalar key, (m, m) arrays 'n' (MMSI with values in both
+            sources), 'bias' (mean of log(row source / column source)) and
+            'rms' (root mean square of that log ratio)
+
+    """
+
+    def __init__(self, raw):
+        entries = _source_entries(raw)
+        self.mmsi = sorted({mmsi for (mmsi, _) in entries})
+        self.names = sorted({name for (_, name) in entries})
+        mmsi_ix = {x: i for (i, x) in enumerate(self.mmsi)}
+        name_ix = {x: i for (i, x) in enumerate(self.names)}
+        n, m = len(self.mmsi), len(self.names)
+        keys = sorted(entries)
+        rows = np.array([mmsi_ix[x] for (x, _) in keys], dtype=int)
+        cols = np.array([name_ix[x] for (_, x) in keys], dtype=int)
+
+        def matrix(values, mask=None):
+            mask = np.ones(len(keys), dtype=bool) if (mask is None) else mask
+            return sparse.coo_matrix((values[mask], (rows[mask], cols[mask])),
+                                     shape=(n, m)).tocsr()
+
+        presence = matrix(np.ones(len(keys)))
+        self.overlap = np.asarray(presence.T.dot(presence).todense()).astype(int)
+
+        # Labels: one column per (source, label) so that the product pairs up
+        # the labels each pair of sources gave every shared mmsi.
+        labels = [combine_classes(entries[x][0]) for x in keys]
+        self.label_names = sorted(set(labels) - {'unknown'})
+        label_ix = {x: i for (i, x) in enumerate(self.label_names)}
+        n_labels = len(self.label_names)
+        has_label = np.array([x != 'unknown' for x in labels], dtype=bool)
+        lab = np.array([label_ix.get(x, -1) for x in labels], dtype=int)
+        self._labels = matrix(lab + 1.0, has_label)
+        self.compatible = self._compatibility(self.label_names)
+        by_label = sparse.coo_matrix(
+            (np.ones(has_label.sum()), (rows[has_label], cols[has_label] * n_labels + lab[has_label])),
+            shape=(n, m * max(n_labels, 1))).tocsr()
+        pairs = by_label.T.dot(by_label).tocoo()
+        s, la = np.divmod(pairs.row, max(n_labels, 1))
+        t, lb = np.divmod(pairs.col, max(n_labels, 1))
+        ok = self.compatible[la, lb] if n_labels else np.zeros(0, dtype=bool)
+        self.agree = np.zeros([m, m], dtype=int)
+        self.conflict = np.zeros([m, m], dtype=int)
+        np.add.at(self.agree, (s[ok], t[ok]), pairs.data[ok].astype(int))
+        np.add.at(self.conflict, (s[~ok], t[~ok]), pairs.data[~ok].astype(int))
+        self.labelled = self.agree + self.conflict
+
+        # Scalars: with a = log value in one source and b in another,
+        # sum (a - b) and sum (a - b)**2 over shared mmsi are bilinear in the
+        # sparse value and presence matrices.
+        self.scalars = {}
+        for key in scalar_keys:
+            values = np.array([np.log(np.mean(entries[x][1][key])) if entries[x][1][key] else 0
+                                   for x in keys])
+            present = np.array([bool(entries[x][1][key]) for x in keys])
+            p = matrix(np.ones(len(keys)), present)
+            v = matrix(values, present)
+            v2 = matrix(values ** 2, present)
+            count = np.asarray(p.T.dot(p).todense())
+            vp = np.asarray(v.T.dot(p).todense())
+            total = vp - vp.T
+            sq = np.asarray((v2.T.dot(p) + p.T.dot(v2) - 2 * v.T.dot(v)).todense())
+            safe = np.maximum(count, 1)
+            self.scalars[key] = {'n': count.astype(int),
+                                 'bias': np.where(count > 0, total / safe, 0.0),
+                                 'rms': np.where(count > 0, np.sqrt(np.maximum(sq, 0) / safe), 0.0)}
+
+    @staticmethod
+    def _compatibility(label_names):
+        """Boolean matrix of which pairs of labels agree"""
+        singles = [combine_classes([x]) for x in label_names]
+        result = np.zeros([len(label_names)] * 2, dtype=bool)
+        for i, a in enumerate(label_names):
+            for j, b in enumerate(label_names):
+                result[i, j] = combine_classes([a, b]) in (singles[i], singles[j])
+        return result
+
+    def conflicts(self, a, b):
+        """List the MMSI whose labels conflict between sources `a` and `b`
+
+        Returns:
+            list of (mmsi, label in `a`, label in `b`)
+
+        """
+        i, j = self.names.index(a), self.names.index(b)
+        la = np.asarray(self._labels[:, i].todense()).ravel().astype(int) - 1
+        lb = np.asarray(self._labels[:, j].todense()).ravel().astype(int) - 1
+        both = np.flatnonzero((la >= 0) & (lb >= 0))
+        bad = both[~self.compatible[la[both], lb[both]]]
+        return [(self.mmsi[k], self.label_names[la[k]], self.label_names[lb[k]]) for k in bad]
+
+    def pairs(self, min_overlap=1):
+        """Rows describing each ordered pair of distinct sources that overlap"""
+        result = []
+        for i, a in enumerate(self.names):
+            for j, b in enumerate(self.names):
+                if i == j or self.overlap[i, j] < min_overlap:
+                    continue
+                row = {'source_a': a, 'source_b': b, 'overlap': int(self.overlap[i, j]),
+                       'labelled': int(self.labelled[i, j]), 'agree': int(self.agree[i, j]),
+                       'conflict': int(self.conflict[i, j])}
+                for key in scalar_keys:
+                    d = self.scalars[key]
+                    row[key + '_n'] = int(d['n'][i, j])
+                    row[key + '_bias'] = float(d['bias'][i, j])
+                    row[key + '_rms'] = float(d['rms'][i, j])
+                result.append(row)
+        return result
+
+    def write_csv(self, path, min_overlap=1):
+        fields = ['source_a', 'source_b', 'overlap', 'labelled', 'agree', 'conflict']
+        for key in scalar_keys:
+            fields += [key + '_n', key + '_bias', key + '_rms']
+        with open(path, 'w') as f:
+            writer = csv.DictWriter(f, fields)
+            writer.writeheader()
+            for row in self.pairs(min_overlap):
+                writer.writerow(row)
+
+
+if __name__ == '__main__':
+    this_directory = os.path.abspath(os.path.dirname(__file__))
+    source_dir = os.path.join(this_directory, "../data-precursors/classification-list-sources")
+    precursor_dir = os.path.join(this_directory, "../data-precursors")
+    parser = argparse.ArgumentParser(description='Compute pairwise agreement between source lists.')
+    parser.add_argument('output', help='Path of the csv to write, one row per pair of sources.')
+    parser.add_argument('--manifest', default=os.path.join(source_dir, MANIFEST_NAME),
+        help='Source manifest to use, if it exists.')
+    parser.add_argument('--min-overlap', type=int, default=1,
+        help='Omit pairs sharing fewer MMSI than this.')
+    parser.add_argument('--conflicts', nargs=2, metavar=('SOURCE_A', 'SOURCE_B'),
+        help='Also print the conflicting MMSI for this pair of sources.')
+    args = parser.parse_args()
+    logging.getLogger().setLevel('WARNING')
+
+    manifest = read_manifest(args.manifest) if os.path.exists(args.manifest) else None
+    raw = load_lists(source_dir, manifest, mmsi_filter=compile_mmsi_filter(precursor_dir))
+    agreement = SourceAgreement(raw)
+    agreement.write_csv(args.output, args.min_overlap)
+    if args.conflicts:
+        for mmsi, a, b in agreement.conflicts(*args.conflicts):
+            print(mmsi, a, b, sep=',')
@@ -0,0 +1,53 @@
+from __future__ import print_function, division
+import unittest
+import numpy as np
+from assemble_class_lists import VesselRecord
+from source_agreement import SourceAgreement
+
+
+def raw_record(mmsi, rows):
+    """Build a loaded record from (source, label, length) rows"""
+    return VesselRecord([mmsi] * len(rows), [x[1] for x in rows], [x[2] for x in rows],
+                        [None] * len(rows), [None] * len(rows), [None] * len(rows),
+                        [None] * len(rows), [x[0] for x in rows])
+
+
+class CheckSourceAgreement(unittest.TestCase):
+
+    def setUp(self):
+        raw = {
+            '1': raw_record('1', [('a', 'trawlers', 10.0), ('b', 'unknown_fishing', 20.0)]),
+            '2': raw_record('2', [('a', 'trawlers', None), ('b', 'cargo', None),
+                                  ('c', 'cargo', None)]),
+            '3': raw_record('3', [('a', '', 10.0), ('b', 'cargo', 10.0)]),
+            '4': raw_record('4', [('c', 'tanker', None)]),
+        }
+        self.agreement = SourceAgreement(raw)
+        self.ix = {x: i for (i, x) in enumerate(self.agreement.names)}
+
+    def test_labels(self):
+        g, a, b, c = self.agreement, self.ix['a'], self.ix['b'], self.ix['c']
+        self.assertEqual(g.overlap[a, b], 3)
+        self.assertEqual(g.overlap[a, c], 1)
+        self.assertEqual(g.labelled[a, b], 2)
+        self.assertEqual(g.agree[a, b], 1)
+        self.assertEqual(g.conflict[a, b], 1)
+        self.assertEqual(g.agree[b, c], 1)
+        self.assertEqual(g.conflicts('a', 'b'), [('2', 'trawlers', 'cargo')])
+        self.assertEqual(g.conflicts('b', 'c'), [])
+
+    def test_scalars(self):
+        length = self.agreement.scalars['length']
+        a, b = self.ix['a'], self.ix['b']
+        self.assertEqual(length['n'][a, b], 2)
+        self.assertAlmostEqual(length['bias'][a, b], -np.log(2) / 2)
+        self.assertAlmostEqual(length['bias'][b, a], np.log(2) / 2)
+        self.assertAlmostEqual(length['rms'][a, b], np.log(2) / np.sqrt(2))
+
+    def test_pairs(self):
+        pairs = self.agreement.pairs(min_overlap=2)
+        self.assertEqual([(x['source_a'], x['source_b']) for x in pairs], [('a', 'b'), ('b', 'a')])
+
+
+if __name__ == '__main__':
+    unittest.main()
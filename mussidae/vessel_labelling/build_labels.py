@@ -4,7 +4,7 @@ import logging
 import datetime
 import os
 
-from vessel_label_mapping import build_labels
+from vessel_label_mapping import build_labels, sweep_labels
 
 if __name__ == '__main__':
     today = datetime.date.today()
@@ -18,6 +18,18 @@ if __name__ == '__main__':
         '--source_csv_dir',
         help='Path to directory containing input vessel lists.',
         default='data/classification-list-sources')
+    parser.add_argument(
+        '--min_messages',
+        help='Minimum number of messages for a usable track (default 1000). '
+        'If more than one value is given, write one output per value, plus '
+        'dataset and label count tables.',
+        type=int,
+        nargs='+')
+    parser.add_argument(
+        '--normalized_dir',
+        help='Normalized store of the vessel lists, written by '
+        'scripts/assemble_class_lists.py --normalized. Lists that are up to '
+        'date in the store are read from it instead of being parsed.')
     parser.add_argument(
         '--log',
         help='Set the logging level.',
@@ -26,4 +38,12 @@ if __name__ == '__main__':
     args = parser.parse_args()
     log_level = getattr(logging, args.log.upper(), None)
     logging.basicConfig(level=log_level)
-    build_labels(logging, args.source_csv_dir, args.output_csv)
+    if args.min_messages is None:
+        build_labels(logging, args.source_csv_dir, args.output_csv,
+                     normalized_dir=args.normalized_dir)
+    elif len(args.min_messages) == 1:
+        build_labels(logging, args.source_csv_dir, args.output_csv,
+                     args.min_messages[0], args.normalized_dir)
+    else:
+        sweep_labels(logging, args.source_csv_dir, args.output_csv,
+                     args.min_messages, args.normalized_dir)
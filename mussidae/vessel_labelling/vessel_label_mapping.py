@@ -5,14 +5,31 @@ import hashlib
 import math
 import os
 import struct
+import sys
 import numpy as np
 
+# The list reading helpers and normalized store format are shared with
+# scripts/assemble_class_lists.py.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import list_files
+import normalized_lists
+
 
 def _utf_8_encoder(unicode_csv_data):
     for line in unicode_csv_data:
         yield line.encode('utf-8')
 
 
+def _open_csv(filename):
+    """Open a possibly compressed csv, also found as 'list.csv.gz' etc."""
+    return list_files.open_list(list_files.find_list(*os.path.split(filename)))
+
+
+def _uncommented(csvfile):
+    """Yield the lines of `csvfile` that are neither empty nor comments."""
+    return (row for row in csvfile if len(row) and row[0] != '#')
+
+
 EXTRA_SALT = "extra_salt"
 
 other = object()
@@ -104,7 +121,7 @@ def _hash_mmsi_to_double(mmsi, salt):
     """
     hasher = hashlib.md5()
     i = '%s_%s' % (mmsi, salt)
-    hasher.update(i)
+    hasher.update(i.encode('utf-8'))
 
     # Pick a number of bytes from the bottom of the hash, and scale the value
     # by the max value that an unsigned integer of that size can have, to get a
@@ -155,11 +172,40 @@ class Dataset(object):
     def logging_name(self):
         """Return a short name for the database for logging
 
-        Name is the base filename with the extension stripped off.
+        Name is the base filename with the extension (and any compression
+        suffix) stripped off.
         """
-        return os.path.splitext(os.path.basename(self._filename))[0]
+        name = list_files.split_list_suffix(os.path.basename(self._filename))[0]
+        return os.path.splitext(name)[0]
+
+    def _normalized_rows(self, normalized_dir):
+        """Return the (mmsi, label) rows of this file from a normalized store.
 
-    def parse(self, logging, vessel_map):
+        Returns None unless the store has an entry built from the current
+        contents of the file with the same mmsi and label columns.
+        """
+        entry = normalized_lists.read_index(normalized_dir)['sources'].get(
+            self.logging_name)
+        filename = list_files.find_list(*os.path.split(self._filename))
+        if (entry is None or
+                entry['headers'].get('mmsi') != self._mmsi_column or
+                entry['headers'].get('label') != self._label_column or
+                entry['csv'] != os.path.basename(filename) or
+                not os.path.exists(filename) or
+                entry['sha1'] != list_files.file_digest(filename)):
+            return None
+        columns = normalized_lists.read_source(normalized_dir, entry)
+        mmsi = normalized_lists.decode_text(columns['mmsi'])
+        labels = normalized_lists.decode_text(columns['raw_label'])
+        # The store keeps every csv row; drop comment lines as when parsing.
+        return [(m, l) for (m, l) in zip(mmsi, labels) if not m.startswith('#')]
+
+    def _csv_rows(self):
+        with _open_csv(self._filename) as csvfile:
+            for row in csv.DictReader(_uncommented(csvfile)):
+                yield row[self._mmsi_column], row[self._label_column]
+
+    def parse(self, logging, vessel_map, normalized_dir=None):
         """Reads and translates the vessel type mapping.
 
          For the given file, read and translate the vessel type mapping and
@@ -169,30 +215,38 @@ class Dataset(object):
             logging: Logging module to report against.
             vessel_map: A dictionary from mmsi to (dataset, vessel label) updated with
                                     the mappings in the current file.
+            normalized_dir: Optional normalized store written by
+                                    scripts/assemble_class_lists.py --normalized. The
+                                    file is read from the store if it is up to date
+                                    there, otherwise the csv is parsed.
         """
-        with open(self._filename, 'r') as csvfile:
-            reader = csv.DictReader(
-                [row for row in csvfile if len(row) and row[0] != '#'])
-            missing_labels = collections.Counter()
-            for row in reader:
-                mmsi = int(row[self._mmsi_column])
-                label = row[self._label_column]
-                if self.has_other or label in self._mapping:
-                    # Get a random value in the range [0 - 1.0] from hashing the mmsi and
-                    # use it to assign this vessel to a dataset.
-                    p = _hash_mmsi_to_double(mmsi, '')
-                    dataset = 'Training' if p < _TRAINING_SET_PROPORTION else 'Test'
-                    mapped_label = self._mapping.get(label, self.other_label)
-                    if mmsi in vessel_map:
-                        _, old_label, old_logname = vessel_map[mmsi]
-                        if mapped_label != old_label:
-                            logging.warning(
-                                "{} overriding class set in {} for {} ({}->{})".
-                                format(self.logging_name, old_logname, mmsi,
-                                       old_label, mapped_label, label))
-                    vessel_map[mmsi] = (dataset, mapped_label, self.logging_name)
-                else:
-                    missing_labels[label] += 1
+        rows = None
+        if normalized_dir is not None:
+            rows = self._normalized_rows(normalized_dir)
+            if rows is None:
+                logging.info('No current normalized copy of %s in %s',
+                             self._filename, normalized_dir)
+        if rows is None:
+            rows = self._csv_rows()
+        missing_labels = collections.Counter()
+        for raw_mmsi, label in rows:
+            mmsi = int(raw_mmsi)
+            if self.has_other or label in self._mapping:
+                # Get a random value in the range [0 - 1.0] from hashing the mmsi and
+                # use it to assign this vessel to a dataset.
+                p = _hash_mmsi_to_double(mmsi, '')
+                dataset = 'Training' if p < _TRAINING_SET_PROPORTION else 'Test'
+                mapped_label = self._mapping.get(label, self.other_label)
+                if mmsi in vessel_map:
+                    _, old_label, old_logname = vessel_map[mmsi]
+                    if mapped_label != old_label:
+                        logging.warning(
+                            "{} overriding class set in {} for {} ({}->{})".
+                            format(self.logging_name, old_logname, mmsi,
+                                   old_label, mapped_label, label))
+                vessel_map[mmsi] = (dataset, mapped_label, self.logging_name)
+            else:
+                missing_labels[label] += 1
 
         logging.info('For filename %s, missing labels: %s', self._filename,
                      missing_labels)
@@ -263,25 +317,25 @@ def get_datasets(destination_path):
 
 def get_message_counts(mmsi_count_path):
     counts = {}
-    with open(mmsi_count_path, 'r') as csvfile:
-        reader = csv.DictReader([row for row in csvfile
-                                 if len(row) and row[0] != '#'])
+    with _open_csv(mmsi_count_path) as csvfile:
+        reader = csv.DictReader(_uncommented(csvfile))
         for row in reader:
             counts[int(row['mmsi'])] = int(row['count'])
 
     return counts
 
 
-def build_labels(logging, source_path, output_filename):
-    """Consolidate vessel labels from multiple sources and write to one csv.
-
-     For the given source path, read a predefined set of prioritised vessel
-     mappings and consolidate and write to a single file.
+def load_labelled_counts(logging, source_path, normalized_dir=None):
+    """Parse the vessel lists and join them with message counts.
 
     Args:
         logging: Logging module to report against.
         source_path: Input path to read source label csvs.
-        output_filename: Filename to write consolidated labels.
+        normalized_dir: Optional normalized store to read the lists from.
+
+    Returns:
+        A list of (message count, mmsi, dataset, label) for every labelled
+        vessel that has a message count.
     """
 
     # Bring in a snapshot of the number of messages per vessel (keyed by mmsi) so
@@ -293,24 +347,130 @@ def build_labels(logging, source_path, output_filename):
 
     mapping = {}
     for ds in get_datasets(source_path):
-        ds.parse(logging, mapping)
+        ds.parse(logging, mapping, normalized_dir)
 
-    vessel_list = []
+    return [(message_counts[mmsi], mmsi, dataset, labels)
+            for mmsi, (dataset, labels, _) in mapping.items()
+            if mmsi in message_counts]
+
+
+def threshold_counts(vessels, thresholds):
+    """Count vessels per dataset and per label for several thresholds.
+
+     Vessels are sorted by message count once; the vessels usable at a
+     threshold are then a prefix of that order, so the counts for every
+     threshold are accumulated in a single pass.
+
+    Args:
+        vessels: A list of (message count, mmsi, dataset, label).
+        thresholds: Minimum message counts to evaluate.
+
+    Returns:
+        A dictionary from threshold to (dataset counts, label counts).
+    """
+    vessels = sorted(vessels, key=lambda x: x[0], reverse=True)
     dataset_vessel_count_map = collections.Counter()
     label_vessel_count_map = collections.Counter()
-    for mmsi, (dataset, labels, _) in mapping.items():
-        if mmsi in message_counts and message_counts[
-                mmsi] >= _MIN_MESSAGES_FOR_USABLE_TRACK:
-            vessel_list.append((mmsi, dataset, labels))
+    result = {}
+    i = 0
+    for threshold in sorted(set(thresholds), reverse=True):
+        while i < len(vessels) and vessels[i][0] >= threshold:
+            _, _, dataset, labels = vessels[i]
             dataset_vessel_count_map[dataset] += 1
             label_vessel_count_map[labels] += 1
+            i += 1
+        result[threshold] = (collections.Counter(dataset_vessel_count_map),
+                             collections.Counter(label_vessel_count_map))
+    return result
 
-    logging.info('Dataset label count: %s', str(dataset_vessel_count_map))
-    logging.info('Class label count: %s', str(label_vessel_count_map))
 
-    vessel_list.sort()
+def write_labels(vessels, min_messages, output_filename):
+    """Write the vessels with at least `min_messages` messages, sorted by mmsi.
 
+    Args:
+        vessels: A list of (message count, mmsi, dataset, label) sorted by mmsi.
+        min_messages: The minimum number of messages for a usable track.
+        output_filename: Filename to write consolidated labels.
+    """
     with open(output_filename, 'w') as output_file:
         output_file.write("mmsi,dataset,label\n")
-        for i, (mmsi, dataset, label) in enumerate(vessel_list):
-            output_file.write('%d,%s,%s\n' % (mmsi, dataset, label))
+        for count, mmsi, dataset, label in vessels:
+            if count >= min_messages:
+                output_file.write('%d,%s,%s\n' % (mmsi, dataset, label))
+
+
+def _write_count_table(filename, column, counts, thresholds):
+    names = sorted(set(k for t in thresholds for k in counts[t]))
+    with open(filename, 'w') as output_file:
+        writer = csv.writer(output_file)
+        writer.writerow([column] + ['min_%d' % t for t in thresholds])
+        for name in names:
+            writer.writerow([name] + [counts[t][name] for t in thresholds])
+
+
+def threshold_filename(output_filename, suffix):
+    """Insert `suffix` into `output_filename` before its extension."""
+    base, ext = os.path.splitext(output_filename)
+    return '%s-%s%s' % (base, suffix, ext or '.csv')
+
+
+def build_labels(logging, source_path, output_filename,
+                 min_messages=_MIN_MESSAGES_FOR_USABLE_TRACK, normalized_dir=None):
+    """Consolidate vessel labels from multiple sources and write to one csv.
+
+     For the given source path, read a predefined set of prioritised vessel
+     mappings and consolidate and write to a single file.
+
+    Args:
+        logging: Logging module to report against.
+        source_path: Input path to read source label csvs.
+        output_filename: Filename to write consolidated labels.
+        min_messages: The minimum number of messages for a usable track.
+        normalized_dir: Optional normalized store to read the lists from.
+    """
+    vessels = load_labelled_counts(logging, source_path, normalized_dir)
+    dataset_vessel_count_map, label_vessel_count_map = threshold_counts(
+        vessels, [min_messages])[min_messages]
+
+    logging.info('Dataset label count: %s', str(dataset_vessel_count_map))
+    logging.info('Class label count: %s', str(label_vessel_count_map))
+
+    vessels.sort(key=lambda x: x[1])
+    write_labels(vessels, min_messages, output_filename)
+
+
+def sweep_labels(logging, source_path, output_filename, thresholds,
+                 normalized_dir=None):
+    """Consolidate vessel labels for several message count thresholds.
+
+     The sources and message counts are read once. For each threshold a
+     label file is written to `output_filename` with '-min<threshold>'
+     inserted before the extension, along with '-dataset-counts' and
+     '-label-counts' tables with one column per threshold.
+
+    Args:
+        logging: Logging module to report against.
+        source_path: Input path to read source label csvs.
+        output_filename: Base filename for the outputs.
+        thresholds: Minimum message counts to evaluate.
+        normalized_dir: Optional normalized store to read the lists from.
+    """
+    thresholds = sorted(set(thresholds))
+    vessels = load_labelled_counts(logging, source_path, normalized_dir)
+    counts = threshold_counts(vessels, thresholds)
+
+    vessels.sort(key=lambda x: x[1])
+    for threshold in thresholds:
+        logging.info('Threshold %d dataset label count: %s', threshold,
+                     str(counts[threshold][0]))
+        logging.info('Threshold %d class label count: %s', threshold,
+                     str(counts[threshold][1]))
+        write_labels(vessels, threshold,
+                     threshold_filename(output_filename, 'min%d' % threshold))
+
+    _write_count_table(
+        threshold_filename(output_filename, 'dataset-counts'), 'dataset',
+        {t: counts[t][0] for t in thresholds}, thresholds)
+    _write_count_table(
+        threshold_filename(output_filename, 'label-counts'), 'label',
+        {t: counts[t][1] for t in thresholds}, thresholds)
@@ -0,0 +1,148 @@
+from __future__ import print_function, division
+import bz2
+import collections
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import vessel_label_mapping
+
+
+# (message count, mmsi, dataset, label)
+VESSELS = [(50, 3, 'a', 'trawlers'),
+           (2000, 1, 'a', 'cargo'),
+           (1000, 2, 'b', 'trawlers'),
+           (1000, 5, 'b', 'cargo'),
+           (10, 4, 'a', 'cargo')]
+
+
+def filtered_counts(vessels, min_messages):
+    """Counts as build_labels computed them before threshold_counts"""
+    dataset_vessel_count_map = collections.Counter()
+    label_vessel_count_map = collections.Counter()
+    for count, _, dataset, labels in vessels:
+        if count >= min_messages:
+            dataset_vessel_count_map[dataset] += 1
+            label_vessel_count_map[labels] += 1
+    return dataset_vessel_count_map, label_vessel_count_map
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+class CheckThresholds(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.load_labelled_counts = vessel_label_mapping.load_labelled_counts
+        vessel_label_mapping.load_labelled_counts = (
+            lambda logging, source_path, normalized_dir=None: list(VESSELS))
+
+    def tearDown(self):
+        vessel_label_mapping.load_labelled_counts = self.load_labelled_counts
+        shutil.rmtree(self.directory)
+
+    def test_threshold_counts(self):
+        counts = vessel_label_mapping.threshold_counts(VESSELS, [1000, 10, 2001, 1000])
+        self.assertEqual(sorted(counts), [10, 1000, 2001])
+        for threshold in [10, 1000, 2001]:
+            self.assertEqual(counts[threshold], filtered_counts(VESSELS, threshold))
+        self.assertEqual(counts[1000][0], {'a': 1, 'b': 2})
+        self.assertEqual(counts[1000][1], {'cargo': 2, 'trawlers': 1})
+        self.assertEqual(counts[2001], ({}, {}))
+        self.assertEqual(vessel_label_mapping.threshold_counts([], [5]), {5: ({}, {})})
+
+    def test_single_threshold(self):
+        path = os.path.join(self.directory, 'labels.csv')
+        vessel_label_mapping.build_labels(logging, self.directory, path, min_messages=1000)
+        self.assertEqual(read(path), 'mmsi,dataset,label\n1,a,cargo\n2,b,trawlers\n5,b,cargo\n')
+
+    def test_threshold_filename(self):
+        self.assertEqual(vessel_label_mapping.threshold_filename('out/labels.csv', 'min10'),
+                         'out/labels-min10.csv')
+        self.assertEqual(vessel_label_mapping.threshold_filename('out.d/labels', 'min10'),
+                         'out.d/labels-min10.csv')
+        self.assertEqual(vessel_label_mapping.threshold_filename('labels.tsv', 'label-counts'),
+                         'labels-label-counts.tsv')
+
+    def test_sweep_labels(self):
+        path = os.path.join(self.directory, 'labels.csv')
+        vessel_label_mapping.sweep_labels(logging, self.directory, path, [1000, 10, 1000])
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['labels-dataset-counts.csv', 'labels-label-counts.csv',
+                          'labels-min10.csv', 'labels-min1000.csv'])
+        single = os.path.join(self.directory, 'single.csv')
+        for threshold in [10, 1000]:
+            vessel_label_mapping.build_labels(logging, self.directory, single,
+                                              min_messages=threshold)
+            self.assertEqual(read(os.path.join(self.directory, 'labels-min%d.csv' % threshold)),
+                             read(single))
+        self.assertEqual(read(os.path.join(self.directory, 'labels-dataset-counts.csv')).split(),
+                         ['dataset,min_10,min_1000', 'a,3,1', 'b,2,2'])
+        self.assertEqual(read(os.path.join(self.directory, 'labels-label-counts.csv')).split(),
+                         ['label,min_10,min_1000', 'cargo,3,2', 'trawlers,2,1'])
+
+
+class CheckCompressedLists(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, file_name, opener, text):
+        with opener(os.path.join(self.directory, file_name), 'wb') as f:
+            f.write(text.encode('utf-8'))
+
+    def test_parse(self):
+        text = '# comment\nMMSI,Type\n1,Trawler\n2,Tug\n3,Unmapped\n'
+        mapping = {'Trawler': 'trawlers', 'Tug': 'tug'}
+        expected = {}
+        plain = vessel_label_mapping.Dataset(os.path.join(self.directory, 'plain.csv'),
+                                             'MMSI', 'Type', mapping)
+        self.write('plain.csv', open, text)
+        plain.parse(logging, expected)
+        self.assertEqual(sorted(expected), [1, 2])
+        for file_name, opener in [('gz.csv.gz', gzip.open), ('bz2.csv.bz2', bz2.BZ2File)]:
+            self.write(file_name, opener, text)
+            # Found from the uncompressed name
+            name = file_name.split('.')[0]
+            dataset = vessel_label_mapping.Dataset(os.path.join(self.directory, name + '.csv'),
+                                                   'MMSI', 'Type', mapping)
+            self.assertEqual(dataset.logging_name, name)
+            vessel_map = {}
+            dataset.parse(logging, vessel_map)
+            self.assertEqual({k: v[:2] for (k, v) in vessel_map.items()},
+                             {k: v[:2] for (k, v) in expected.items()})
+
+    def test_carriage_returns(self):
+        text = 'MMSI,Type\r1,Trawler\r2,Tug\r'
+        mapping = {'Trawler': 'trawlers', 'Tug': 'tug'}
+        for file_name, opener in [('cr.csv.gz', gzip.open), ('cr.csv.bz2', bz2.BZ2File)]:
+            self.write(file_name, opener, text)
+            dataset = vessel_label_mapping.Dataset(os.path.join(self.directory, 'cr.csv'),
+                                                   'MMSI', 'Type', mapping)
+            vessel_map = {}
+            dataset.parse(logging, vessel_map)
+            self.assertEqual(sorted(vessel_map), [1, 2])
+            os.remove(os.path.join(self.directory, file_name))
+
+    def test_get_message_counts(self):
+        text = 'mmsi,count\n1,10\n2,2000\n'
+        self.write('counts.csv.gz', gzip.open, text)
+        self.assertEqual(vessel_label_mapping.get_message_counts(
+                             os.path.join(self.directory, 'counts.csv')),
+                         {1: 10, 2: 2000})
+        self.write('counts.csv', open, text)
+        self.assertEqual(vessel_label_mapping.get_message_counts(
+                             os.path.join(self.directory, 'counts.csv')),
+                         {1: 10, 2: 2000})
+
+
+if __name__ == '__main__':
+    unittest.main()